@@ -5,19 +5,23 @@ Xiuming Zhang, MIT CSAIL
 November 2017
 """
 
-from os.path import join
+from os import makedirs, cpu_count, replace
+from os.path import join, exists
+from itertools import islice, count
 import numpy as np
 import cv2
 from xiuminglib import visualization as xvis
 
 
 class LucasKanadeTracker:
-    def __init__(self, frames, pts, backtrack_thres=1, lk_params=None):
+    def __init__(self, frames, pts, backtrack_thres=1, lk_params=None, n_frames=None, out_dir=None):
         """
         Args:
-            frames: Frame images in order
-                List of h-by-w or h-by-w-by-3 numpy arrays
-                Color images will be converted to grayscale
+            frames: Frame images in order, read lazily, so that only the frame pair being
+                tracked between is in memory
+                List or iterator (e.g., generator) of h-by-w or h-by-w-by-3 numpy arrays,
+                    cv2.VideoCapture, or glob pattern of image paths (sorted by path)
+                Color images will be converted to grayscale as they are read
             pts: Points to track in the first frame
                 Array_like of shape (n, 2)
                     +------------>
@@ -32,26 +36,32 @@ class LucasKanadeTracker:
             lk_params: Keyword parameters for calcOpticalFlowPyrLK()
                 Dictionary of parameter name-value pairs
                 Optional
+            n_frames: Number of frames to track through. Required by 'out_dir' if 'frames' is
+                an iterator, whose length is unknown
+                Positive integer
+                Optional; defaults to None (all frames)
+            out_dir: Directory to write results to as memory-mapped tracks.npy, can_backtrack.npy
+                and is_lost.npy, instead of keeping them in memory
+                String
+                Optional; defaults to None
 
         Result attrs:
             tracks: Positions of tracks from the i-th to (i+1)-th frame
-                List of n-by-2 numpy arrays
+                Numpy array of shape (n_frames - 1, n, 2)
                     +------------>
-                    |       tracks[:, 1]
+                    |       tracks[:, :, 1]
                     |
                     |
-                    v tracks[:, 0]
+                    v tracks[:, :, 0]
             can_backtrack: Whether each track can be back-tracked to the previous frame
-                List of Boolean numpy arrays of length n
+                Boolean numpy array of shape (n_frames - 1, n)
             is_lost: Whether each track is lost in this frame
-                List of Boolean numpy arrays of length n
+                Boolean numpy array of shape (n_frames - 1, n)
         """
-        frames_gs = []
-        for img in frames:
-            if img.ndim == 3:
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            frames_gs.append(img)
-        self.frames = frames_gs
+        self.frames = frames
+        self.n_frames = n_frames
+        self.out_dir = out_dir
+        self._frames_consumed = False
 
         self.pts = np.array(pts)
 
@@ -65,32 +75,56 @@ class LucasKanadeTracker:
                 self.lk_params[key] = val
 
         self.backtrack_thres = backtrack_thres
-        self.tracks = []
-        self.can_backtrack = []
-        self.is_lost = []
+        n = self.pts.shape[0]
+        self.tracks = np.zeros((0, n, 2), dtype=np.float32)
+        self.can_backtrack = np.zeros((0, n), dtype=bool)
+        self.is_lost = np.zeros((0, n), dtype=bool)
 
-    def run(self, constrain=None):
+    def run(self, constrain=None, pipeline=False, n_workers=1, chunk_size=None):
         """
         Args:
             constrain: Function applied to tracks before being fed to the next round
                 function that takes in an n-by-2 numpy array as well as the current workspace
                 (as a dictionary) and returns another n-by-2 numpy array
                 Optional; defaults to None
+            pipeline: Whether to back-track the i-th frame pair in a background thread while
+                the (i+1)-th pair is being tracked forward. Results are identical. Ignored when
+                constrain is given, as it sees the back-tracking results of the current pair
+                Boolean
+                Optional; defaults to False
+            n_workers: Number of processes, each tracking chunks of the points between frames
+                shared with them via shared memory. Results are identical. Cannot be used with
+                constrain, which sees all points; pipeline is then ignored
+                Positive integer
+                Optional; defaults to 1
+            chunk_size: Number of points per chunk when n_workers > 1
+                Positive integer
+                Optional; defaults to None (one chunk per worker, as each chunk builds both
+                frames' pyramids again)
         """
-        for fi in range(0, len(self.frames) - 1):
-            f0, f1 = self.frames[fi], self.frames[fi + 1]
+        if n_workers != 1 and constrain is not None:
+            raise ValueError("'constrain' sees all points, so they cannot be tracked in chunks")
+
+        self._alloc_results()
+
+        if n_workers != 1:
+            self._run_parallel(n_workers, chunk_size)
+            return
+
+        if pipeline and constrain is None:
+            self._run_pipelined()
+            return
 
+        n_pairs = 0
+        for fi, (f0, f1) in enumerate(self._frame_pairs()):
             if fi == 0:
                 p0 = self._my2klt(self.pts)
 
             # Track with forward flow
-            p1, not_lost, err = cv2.calcOpticalFlowPyrLK(f0, f1, p0, None, **self.lk_params)
-            is_lost = (1 - not_lost.ravel()).astype(bool)
-            err = err.ravel()
+            p1, is_lost, err = self._track_forward(f0, f1, p0)
 
             # Check quality by back-tracking
-            p0r, _, _ = cv2.calcOpticalFlowPyrLK(f1, f0, p1, None, **self.lk_params)
-            can_backtrack = abs(p0 - p0r).reshape(-1, 2).max(-1) < self.backtrack_thres
+            can_backtrack = self._backtrack(f0, f1, p0, p1)
 
             # Continue tracking these points or impose some constraints
             if constrain is None:
@@ -100,13 +134,245 @@ class LucasKanadeTracker:
                 pts = constrain(pts, locals())
                 p0 = self._my2klt(pts)
 
-            self.tracks.append(self._klt2my(p0))
-            self.can_backtrack.append(can_backtrack)
-            self.is_lost.append(is_lost)
+            self._grow_results(fi)
+            self.tracks[fi] = self._klt2my(p0)
+            self.can_backtrack[fi] = can_backtrack
+            self.is_lost[fi] = is_lost
+            n_pairs = fi + 1
+
+        self._trim_results(n_pairs)
+
+    def _run_pipelined(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        p0 = self._my2klt(self.pts)
+        n_pairs, backtracked = 0, None
+
+        # OpenCV releases the GIL, so back-tracking a pair overlaps with tracking the next
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for fi, (f0, f1) in enumerate(self._frame_pairs()):
+                p1, is_lost, _ = self._track_forward(f0, f1, p0)
+                self._grow_results(fi)
+                # At most one pair in flight, so that at most three frames are in memory
+                if backtracked is not None:
+                    self.can_backtrack[fi - 1] = backtracked.result()
+                backtracked = executor.submit(self._backtrack, f0, f1, p0, p1)
+                self.tracks[fi] = self._klt2my(p1)
+                self.is_lost[fi] = is_lost
+                p0 = p1
+                n_pairs = fi + 1
+
+            if backtracked is not None:
+                self.can_backtrack[n_pairs - 1] = backtracked.result()
+
+        self._trim_results(n_pairs)
+
+    def _run_parallel(self, n_workers, chunk_size):
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import shared_memory
 
-    def vis(self, out_dir, marker_bgr=(0, 0, 255)):
-        for fi in range(0, len(self.frames) - 1):
-            im = self.frames[fi + 1]
+        frames = self._iter_frames()
+        f0 = next(frames, None)
+        if f0 is None:
+            self._trim_results(0)
+            return
+
+        n = self.pts.shape[0]
+        if chunk_size is None:
+            chunk_size = max(int(np.ceil(n / (n_workers or cpu_count()))), 1)
+        chunks = [(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+
+        # Two frame slots in shared memory, written in turn: by the time a frame is written,
+        # the pair that used the slot before has been tracked
+        shm = shared_memory.SharedMemory(create=True, size=2 * f0.nbytes)
+        slots = np.ndarray((2,) + f0.shape, dtype=f0.dtype, buffer=shm.buf)
+        slots[0] = f0
+
+        p0 = self._my2klt(self.pts)
+        n_pairs = 0
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=n_workers, initializer=_lk_init_worker,
+                    initargs=(shm.name, slots.shape, slots.dtype.str,
+                              self.lk_params, self.backtrack_thres)) as executor:
+                f1 = next(frames, None)
+                for fi in count():
+                    if f1 is None:
+                        break
+                    if f1.shape != f0.shape or f1.dtype != f0.dtype:
+                        raise ValueError("All frames must be of the same size and type")
+                    slots[(fi + 1) % 2] = f1
+                    futures = [executor.submit(_lk_track_chunk, fi % 2, (fi + 1) % 2, p0[i:j])
+                               for i, j in chunks]
+
+                    # Read the next frame while this pair is being tracked
+                    f1 = next(frames, None)
+
+                    # Chunks go back to where they came from, so the order workers finish in
+                    # does not matter
+                    self._grow_results(fi)
+                    p1 = np.empty_like(p0)
+                    for (i, j), future in zip(chunks, futures):
+                        p1[i:j], self.is_lost[fi, i:j], self.can_backtrack[fi, i:j] = \
+                            future.result()
+                    self.tracks[fi] = self._klt2my(p1)
+                    p0 = p1
+                    n_pairs = fi + 1
+        finally:
+            # Views must go before the buffer can be closed
+            del slots
+            shm.close()
+            shm.unlink()
+
+        self._trim_results(n_pairs)
+
+    def _track_forward(self, f0, f1, p0):
+        p1, not_lost, err = cv2.calcOpticalFlowPyrLK(f0, f1, p0, None, **self.lk_params)
+        is_lost = (1 - not_lost.ravel()).astype(bool)
+        return p1, is_lost, err.ravel()
+
+    def _backtrack(self, f0, f1, p0, p1):
+        p0r, _, _ = cv2.calcOpticalFlowPyrLK(f1, f0, p1, None, **self.lk_params)
+        return abs(p0 - p0r).reshape(-1, 2).max(-1) < self.backtrack_thres
+
+    def _iter_frames(self, frames=None):
+        """
+        Grayscale frames, read and converted one at a time
+        """
+        is_own = frames is None
+        if is_own:
+            if self._frames_consumed:
+                raise ValueError("Frames were given as an iterator, which has been used up")
+            frames = self.frames
+
+        if isinstance(frames, str):
+            from glob import glob
+            # In color, so that the conversion to grayscale is the same as for other sources
+            frames = (cv2.imread(x) for x in sorted(glob(frames)))
+        elif isinstance(frames, cv2.VideoCapture):
+            frames = _read_video(frames)
+            self._frames_consumed = self._frames_consumed or is_own
+        elif iter(frames) is frames:
+            self._frames_consumed = self._frames_consumed or is_own
+
+        if self.n_frames is not None:
+            frames = islice(frames, self.n_frames)
+
+        for img in frames:
+            if img.ndim == 3:
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            yield img
+
+    def _frame_pairs(self):
+        """
+        Consecutive frame pairs, keeping only the current pair in memory
+        """
+        frames = self._iter_frames()
+        f0 = next(frames, None)
+        for f1 in frames:
+            yield f0, f1
+            f0 = f1
+
+    def _len_frames(self):
+        """
+        Number of frames, if known without reading them
+        """
+        if isinstance(self.frames, str):
+            from glob import glob
+            n = len(glob(self.frames))
+        elif hasattr(self.frames, '__len__'):
+            n = len(self.frames)
+        else:
+            return self.n_frames
+        if self.n_frames is not None:
+            n = min(n, self.n_frames)
+        return n
+
+    def _alloc_results(self):
+        """
+        Preallocates result arrays, memory-mapped if 'out_dir' is set
+        """
+        n_frames = self._len_frames()
+        if n_frames is None:
+            if self.out_dir is not None:
+                raise ValueError(("'n_frames' is required to write results to 'out_dir' "
+                                  "when frames come from an iterator or a video"))
+            n_pairs = 16 # grown as needed
+        else:
+            n_pairs = max(n_frames - 1, 0)
+        n = self.pts.shape[0]
+
+        if self.out_dir is None:
+            self.tracks = np.zeros((n_pairs, n, 2), dtype=np.float32)
+            self.can_backtrack = np.zeros((n_pairs, n), dtype=bool)
+            self.is_lost = np.zeros((n_pairs, n), dtype=bool)
+        else:
+            # Make directory, if necessary
+            if not exists(self.out_dir):
+                makedirs(self.out_dir, exist_ok=True)
+            self.tracks = np.lib.format.open_memmap(
+                join(self.out_dir, 'tracks.npy'), mode='w+', dtype=np.float32, shape=(n_pairs, n, 2))
+            self.can_backtrack = np.lib.format.open_memmap(
+                join(self.out_dir, 'can_backtrack.npy'), mode='w+', dtype=bool, shape=(n_pairs, n))
+            self.is_lost = np.lib.format.open_memmap(
+                join(self.out_dir, 'is_lost.npy'), mode='w+', dtype=bool, shape=(n_pairs, n))
+
+    def _grow_results(self, fi):
+        """
+        Doubles in-memory result arrays if the fi-th frame pair does not fit
+        """
+        if fi < self.tracks.shape[0]:
+            return
+        assert self.out_dir is None, "More frames than 'n_frames' in a memory map"
+        n_more = max(self.tracks.shape[0], 16)
+        self.tracks = np.concatenate(
+            (self.tracks, np.zeros((n_more,) + self.tracks.shape[1:], dtype=self.tracks.dtype)))
+        self.can_backtrack = np.concatenate(
+            (self.can_backtrack, np.zeros((n_more,) + self.can_backtrack.shape[1:], dtype=bool)))
+        self.is_lost = np.concatenate(
+            (self.is_lost, np.zeros((n_more,) + self.is_lost.shape[1:], dtype=bool)))
+
+    def _trim_results(self, n_pairs):
+        """
+        Drops unused rows, also from the files if the frames ran out before 'n_frames'
+        """
+        names = ('tracks', 'can_backtrack', 'is_lost')
+        if self.out_dir is None:
+            for name in names:
+                setattr(self, name, getattr(self, name)[:n_pairs])
+            return
+
+        for name in names:
+            x = getattr(self, name)
+            x.flush()
+            if n_pairs == x.shape[0]:
+                continue
+            # Rows past the end would otherwise read as real tracks, so rewrite shorter files
+            path = join(self.out_dir, name + '.npy')
+            tmp_path = join(self.out_dir, name + '_tmp.npy')
+            trimmed = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=x.dtype, shape=(n_pairs,) + x.shape[1:])
+            trimmed[:] = x[:n_pairs]
+            trimmed.flush()
+            del x, trimmed
+            replace(tmp_path, path)
+            setattr(self, name, np.load(path, mmap_mode='r+'))
+
+    def vis(self, out_dir, marker_bgr=(0, 0, 255), frames=None):
+        """
+        Args:
+            out_dir: Directory to write one image per frame (but the first) with tracks drawn
+                String
+            marker_bgr: BGR color of track markers
+                Tuple of three integers
+                Optional; defaults to (0, 0, 255)
+            frames: Frames to draw on, in the same formats as accepted by __init__()
+                Optional; defaults to None (frames given to __init__(), which must not have
+                been an iterator or video, as they have already been read by run())
+        """
+        frames = self._iter_frames(frames)
+        next(frames, None)
+        for fi, im in enumerate(islice(frames, self.tracks.shape[0])):
             pts = self.tracks[fi]
             xvis.scatter_on_image(im, pts, size=6, bgr=marker_bgr,
                                   outpath=join(out_dir, '%04d.png' % (fi + 1)))
@@ -137,3 +403,31 @@ class LucasKanadeTracker:
         Inverse of _my2klt()
         """
         return pts.reshape(-1, 2)[:, ::-1]
+
+
+def _read_video(cap):
+    while True:
+        success, img = cap.read()
+        if not success:
+            break
+        yield img
+
+
+_lk_worker = {}
+
+
+def _lk_init_worker(shm_name, shape, dtype, lk_params, backtrack_thres):
+    from multiprocessing import shared_memory
+
+    _lk_worker['shm'] = shared_memory.SharedMemory(name=shm_name)
+    _lk_worker['slots'] = np.ndarray(shape, dtype=dtype, buffer=_lk_worker['shm'].buf)
+    _lk_worker['tracker'] = LucasKanadeTracker(
+        [], np.zeros((0, 2)), backtrack_thres=backtrack_thres, lk_params=lk_params)
+
+
+def _lk_track_chunk(slot0, slot1, p0):
+    f0, f1 = _lk_worker['slots'][slot0], _lk_worker['slots'][slot1]
+    tracker = _lk_worker['tracker']
+    p1, is_lost, _ = tracker._track_forward(f0, f1, p0)
+    can_backtrack = tracker._backtrack(f0, f1, p0, p1)
+    return p1, is_lost, can_backtrack
@@ -229,32 +229,81 @@ def ptcld2tdf(pts, res=128, center=False):
         tdf: Output TDF
             res-by-res-by-res numpy array of floats
     """
-    pts = np.array(pts)
+    vox_ind, vox_tdf = ptcld2tdf_sparse(pts, res=res, center=center)
 
-    n_pts = pts.shape[0]
+    tdf = np.ones((res, res, res)) / res
+    tdf[vox_ind[:, 0], vox_ind[:, 1], vox_ind[:, 2]] = vox_tdf
 
-    if center:
-        pts_center = np.mean(pts, axis=0)
-        pts -= np.tile(pts_center, (n_pts, 1))
+    return tdf
 
-    tdf = np.ones((res, res, res)) / res
-    cnt = np.zeros((res, res, res))
+
+def ptcld2tdf_sparse(pts, res=128, center=False):
+    """
+    Same as ptcld2tdf(), but keeps only voxels containing points: all others are at the cap,
+        1 / res, anyway
+
+    Args:
+        pts, res, center: See ptcld2tdf()
+
+    Returns:
+        vox_ind: Indices of voxels containing points, sorted
+            m-by-3 numpy array of integers
+        vox_tdf: TDF values of these voxels, i.e., mean distance from voxel center to the points
+            1D numpy array of floats of length m
+    """
+    pts = np.array(pts, dtype=float).reshape(-1, 3)
+
+    if center:
+        pts -= np.mean(pts, axis=0)
 
     # -0.5 to 0.5 in every dimension
     extent = 2 * np.abs(pts).max()
     pts_scaled = pts / extent
 
-    # Compute distance from center of each involved voxel to its surface points
-    for i in range(n_pts):
-        pt = pts_scaled[i, :]
-        ind = np.floor((pt + 0.5) * (res - 1)).astype(int)
-        v_ctr = (ind + 0.5) / (res - 1) - 0.5
-        dist = np.linalg.norm(pt - v_ctr)
-        n = cnt[ind[0], ind[1], ind[2]]
-        tdf[ind[0], ind[1], ind[2]] = (tdf[ind[0], ind[1], ind[2]] * n + dist) / (n + 1)
-        cnt[ind[0], ind[1], ind[2]] += 1
+    # Distance from center of each involved voxel to its surface points
+    ind = np.floor((pts_scaled + 0.5) * (res - 1)).astype(int)
+    v_ctr = (ind + 0.5) / (res - 1) - 0.5
+    dist = np.linalg.norm(pts_scaled - v_ctr, axis=1)
 
-    return tdf
+    # Averaged per voxel
+    keys = (ind[:, 0] * res + ind[:, 1]) * res + ind[:, 2]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    is_first = np.concatenate(([True], keys[1:] != keys[:-1]))
+    starts = np.flatnonzero(is_first)
+    vox_tdf = np.add.reduceat(dist[order], starts) / np.diff(np.append(starts, len(keys)))
+    vox_ind = ind[order[starts]]
+
+    return vox_ind, vox_tdf
+
+
+def decimate_ptcld(pts, voxel_size):
+    """
+    Subsample point cloud on a voxel grid, keeping one point (the first) per occupied voxel
+
+    Args:
+        pts: Cartesian coordinates
+            n-by-3 array_like of floats
+        voxel_size: Side length of the voxels
+            Positive float
+
+    Returns:
+        ind: Indices of the points kept, in ascending order
+            1D numpy array of integers
+    """
+    pts = np.asarray(pts)
+    if pts.shape[0] == 0:
+        return np.zeros(0, dtype=int)
+
+    # One integer key per voxel
+    vox = np.floor((pts - pts.min(axis=0)) / voxel_size).astype(np.int64)
+    n_vox = vox.max(axis=0) + 1
+    keys = (vox[:, 0] * n_vox[1] + vox[:, 1]) * n_vox[2] + vox[:, 2]
+
+    # First point of each voxel; stable sorting keeps input order among equal keys
+    order = np.argsort(keys, kind='stable')
+    is_first = np.concatenate(([True], keys[order[1:]] != keys[order[:-1]]))
+    return np.sort(order[is_first])
 
 
 if __name__ == '__main__':
@@ -28,7 +28,8 @@ class Obj(object):
                 *-by-3 numpy array of floats
                 Optional; defaults to None
             f: Faces' vertex indices
-                List of lists of integers starting from 1, e.g., '[[1, 2, 3], [4, 5, 6], [7, 8, 9, 10], ...]'
+                List of lists of integers starting from 1, e.g., '[[1, 2, 3], [4, 5, 6], [7, 8, 9, 10], ...]',
+                    or *-by-k numpy array thereof (all faces having k vertices)
                 Optional; defaults to None
             vn: Vertex normals
                 *-by-3 numpy array of floats, normalized or unnormalized
@@ -306,14 +307,11 @@ class Obj(object):
             fid.write('o %s\n' % o)
 
             # Vertices
-            for i in range(v.shape[0]):
-                fid.write('v %f %f %f\n' % tuple(v[i, :]))
+            np.savetxt(fid, v, fmt='v %f %f %f')
             if vt is not None:
-                for i in range(vt.shape[0]):
-                    fid.write('vt %f %f\n' % tuple(vt[i, :]))
+                np.savetxt(fid, vt, fmt='vt %f %f')
             if vn is not None:
-                for i in range(vn.shape[0]):
-                    fid.write('vn %f %f %f\n' % tuple(vn[i, :]))
+                np.savetxt(fid, vn, fmt='vn %f %f %f')
 
             # Material name
             if usemtl is not None:
@@ -326,7 +324,20 @@ class Obj(object):
                 fid.write('s off\n')
 
             # Faces
-            if ft is None and fn is None: # just f (1 2 3)
+            if isinstance(f, np.ndarray) and all(
+                    x is None or (isinstance(x, np.ndarray) and x.shape == f.shape) for x in (ft, fn)):
+                # All faces with the same number of vertices: in one go
+                if ft is None and fn is None:
+                    fmt = ' %d'
+                elif fn is None:
+                    fmt = ' %d/%d'
+                elif ft is None:
+                    fmt = ' %d//%d'
+                else:
+                    fmt = ' %d/%d/%d'
+                ids = np.stack([x for x in (f, ft, fn) if x is not None], axis=2)
+                np.savetxt(fid, ids.reshape(f.shape[0], -1), fmt='f' + fmt * f.shape[1])
+            elif ft is None and fn is None: # just f (1 2 3)
                 for v_id in f:
                     fid.write(('f' + ' %d' * len(v_id) + '\n') % tuple(v_id))
             elif ft is not None and fn is None: # f and ft (1/1 2/2 3/3 or 1 2 3)
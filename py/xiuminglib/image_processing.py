@@ -115,7 +115,7 @@ def remove_islands(im, min_n_pixels, connectivity=4):
 
     # Find islands, big or small
     nlabels, labelmap, leftx_topy_bbw_bbh_npix, _ = \
-        cv2.connectedComponentsWithStats(im, connectivity)
+        cv2.connectedComponentsWithStats(im, connectivity=connectivity)
 
     # Figure out background is 0 or 1
     bgval = im[labelmap == 0][0]
@@ -184,10 +184,8 @@ def query_float_locations(im, query_pts, method='bilinear'):
     elif query_pts.ndim != 2 or query_pts.shape[1] != 2:
         raise ValueError("Shape of input must be either (2,) or (n, 2)")
 
-    # Querying one point, very likely in a loop -- no printing
-    if is_one_point:
-        import logging
-        logger.setLevel(logging.WARN)
+    # Querying one point, very likely in a loop -- no printing (without silencing the shared logger)
+    verbose = not is_one_point
 
     x = np.arange(h) + 0.5 # pixel center
     y = np.arange(w) + 0.5
@@ -202,7 +200,8 @@ def query_float_locations(im, query_pts, method='bilinear'):
         # Single channel
         z = im
 
-        logger.info("Interpolation (method: %s) started", method)
+        if verbose:
+            logger.info("Interpolation (method: %s) started", method)
 
         if method == 'spline':
             spline_obj = RectBivariateSpline(x, y, z)
@@ -215,7 +214,8 @@ def query_float_locations(im, query_pts, method='bilinear'):
         else:
             raise NotImplementedError("Other interplation methods")
 
-        logger.info("    ... done")
+        if verbose:
+            logger.info("    ... done")
 
     else:
         # Multiple channels
@@ -226,7 +226,8 @@ def query_float_locations(im, query_pts, method='bilinear'):
 
             z = im[:, :, i]
 
-            logger.info("Interpolation (method: %s) started for channel %d/%d", method, i + 1, c)
+            if verbose:
+                logger.info("Interpolation (method: %s) started for channel %d/%d", method, i + 1, c)
 
             if method == 'spline':
                 spline_obj = RectBivariateSpline(x, y, z)
@@ -239,7 +240,8 @@ def query_float_locations(im, query_pts, method='bilinear'):
             else:
                 raise NotImplementedError("Other interplation methods")
 
-            logger.info("    ... done")
+            if verbose:
+                logger.info("    ... done")
 
     if is_one_point:
         interp_val = interp_val.reshape(c)
@@ -247,61 +249,187 @@ def query_float_locations(im, query_pts, method='bilinear'):
     return interp_val
 
 
-def find_local_extrema(im, want_maxima, kernel_size=3):
+def query_float_locations_batch(ims, query_pts, out=None):
+    """
+    Bilinearly interpolate values at float locations on a batch of same-size images
+        Same pixel-center convention as query_float_locations(), but vectorized over images,
+        points and channels, and without any logging, so it can be called in tight loops;
+        locations outside the outermost pixel centers take the border values
+
+    Args:
+        ims: Images of the same size
+            Numpy array of shape (b, h, w) or (b, h, w, c)
+        query_pts: Query locations, one set per image
+            Numpy array of shape (b, n, 2)
+            +-----------> dim1
+            |
+            |
+            |
+            v dim0
+        out: Where to write the results
+            Float numpy array of shape (b, n) or (b, n, c)
+            Optional; defaults to None (allocate one)
+
+    Returns:
+        interp_val: Interpolated values at query locations, i.e., 'out' if provided
+            Numpy array of shape (b, n) or (b, n, c), float32 unless 'ims' is float64
+    """
+    if ims.ndim not in (3, 4):
+        raise ValueError("'ims' must be (b, h, w) or (b, h, w, c)")
+    b, h, w = ims.shape[:3]
+    if query_pts.ndim != 3 or query_pts.shape[0] != b or query_pts.shape[2] != 2:
+        raise ValueError("'query_pts' must be (b, n, 2)")
+    n = query_pts.shape[1]
+
+    if out is None:
+        out = np.empty((b, n) + ims.shape[3:], dtype=np.result_type(ims.dtype, np.float32))
+
+    # From pixel-center coordinates to array indices
+    x = np.clip(query_pts[:, :, 0] - 0.5, 0, h - 1)
+    y = np.clip(query_pts[:, :, 1] - 0.5, 0, w - 1)
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    x1 = np.minimum(x0 + 1, h - 1)
+    y1 = np.minimum(y0 + 1, w - 1)
+    fx = (x - x0).astype(out.dtype)
+    fy = (y - y0).astype(out.dtype)
+    if ims.ndim == 4:
+        fx, fy = fx[:, :, None], fy[:, :, None]
+
+    # Gather the four neighbors of all points in all images at once
+    flat = ims.reshape((b, h * w) + ims.shape[3:])
+    bi = np.arange(b)[:, None]
+    out[...] = flat[bi, x0 * w + y0] * ((1 - fx) * (1 - fy))
+    out += flat[bi, x0 * w + y1] * ((1 - fx) * fy)
+    out += flat[bi, x1 * w + y0] * (fx * (1 - fy))
+    out += flat[bi, x1 * w + y1] * (fx * fy)
+
+    return out
+
+
+def _iter_tiles(h, w, tile_size, halo):
+    """
+    Iterate over tiles of an h-by-w image, each padded with a halo clipped to the image
+
+    Args:
+        h, w: Image height and width
+            Positive integers
+        tile_size: Side length(s) of each tile (without halo)
+            Positive integer or 2-tuple thereof
+        halo: Number of extra pixels on each side that a neighborhood operation needs
+            Non-negative integer
+
+    Yields:
+        src: Rows and columns of the padded tile in the image
+            2-tuple of slices
+        core: Rows and columns of the tile core, relative to the padded tile
+            2-tuple of slices
+        dst: Rows and columns of the tile core in the image
+            2-tuple of slices
+    """
+    if isinstance(tile_size, int):
+        tile_size = (tile_size, tile_size)
+    tile_h, tile_w = tile_size
+    for r0 in range(0, h, tile_h):
+        r1 = min(r0 + tile_h, h)
+        pr0, pr1 = max(r0 - halo, 0), min(r1 + halo, h)
+        for c0 in range(0, w, tile_w):
+            c1 = min(c0 + tile_w, w)
+            pc0, pc1 = max(c0 - halo, 0), min(c1 + halo, w)
+            yield (slice(pr0, pr1), slice(pc0, pc1)), \
+                (slice(r0 - pr0, r1 - pr0), slice(c0 - pc0, c1 - pc0)), \
+                (slice(r0, r1), slice(c0, c1))
+
+
+def _sort_extrema(ind, val, want_maxima, n_top):
+    """
+    Sort extrema by value (ties broken by position) and keep the top ones
+    """
+    # Negated in float, as negating unsigned integers wraps around
+    key = -val.astype(float) if want_maxima else val
+    order = np.lexsort(ind[::-1] + (key,))[:n_top]
+    return tuple(x[order] for x in ind), val[order]
+
+
+def find_local_extrema(im, want_maxima, kernel_size=3, n_top=None, tile_size=None):
     """
     Find local maxima or minima in an image
+        All channels are filtered in a single call with a separable (per-axis) window
 
     Args:
         im: Single-channel (e.g., grayscale) or multi-channel (e.g., RGB) images
-            h-by-w or h-by-w-by-c numpy array
+            h-by-w or h-by-w-by-c numpy array (or numpy.memmap)
             Extrema are found independently for each of the c channels
         want_maxima: Whether maxima or minima is wanted
             Boolean
         kernel_size: Side length of the square window under consideration
             Integer larger than 1
             Optional; defaults to 3
+        n_top: Return only this many strongest extrema (largest maxima or smallest minima)
+            instead of the dense map
+            Positive integer
+            Optional; defaults to None (return the dense map)
+        tile_size: Process the image in tiles of this size (plus halos) to bound memory,
+            e.g., for gigapixel images; results are identical to the untiled version
+            Positive integer or 2-tuple thereof
+            Optional; defaults to None (whole image at once)
 
     Returns:
-        is_extremum: Binary map indicating if each pixel is a local extremum
+        is_extremum: Binary map indicating if each pixel is a local extremum; returned
+            if 'n_top' is None
             Boolean numpy array of the same size as 'im'
+        ind: Indices of the extrema, sorted from the strongest; returned with 'val' if
+            'n_top' is given
+            2- or 3-tuple (same as im.ndim) of numpy arrays of at most n_top integers
+        val: Values of the extrema, i.e., `im[ind]`
+            Numpy array of at most n_top values
     """
-    from scipy.ndimage.filters import minimum_filter, maximum_filter
-
-    logger.error("find_local_extrema() not tested yet!")
+    from scipy.ndimage import minimum_filter, maximum_filter
 
     # Figure out image size and number of channels
     if im.ndim == 3:
-        h, w, c = im.shape
-        expanded = False
+        size = (kernel_size, kernel_size, 1) # no filtering across channels
     elif im.ndim == 2:
-        h, w = im.shape
-        c = 1
-        im = np.expand_dims(im, axis=2) # adds singleton dimension
-        expanded = True
+        size = (kernel_size, kernel_size)
     else:
         raise ValueError("'im' must have either two or three dimensions")
+    h, w = im.shape[:2]
 
-    kernel = np.ones((kernel_size, kernel_size)).astype(bool)
+    filter_func = maximum_filter if want_maxima else minimum_filter
 
-    is_extremum = np.zeros((h, w, c), dtype=bool)
-
-    for i in range(c):
-        z = im[:, :, i]
+    if tile_size is None:
+        tiles = [((slice(0, h), slice(0, w)),) * 3]
+    else:
+        # Halo wide enough for the filter window, so tiles agree with the whole image
+        tiles = _iter_tiles(h, w, tile_size, kernel_size // 2)
 
-        if want_maxima:
-            equals_extremum = maximum_filter(z, footprint=kernel) == z
-        else:
-            equals_extremum = minimum_filter(z, footprint=kernel) == z
+    if n_top is None:
+        is_extremum = np.zeros(im.shape, dtype=bool)
+    else:
+        ind = tuple(np.zeros(0, dtype=int) for _ in range(im.ndim))
+        val = np.zeros(0, dtype=im.dtype)
 
-        is_extremum[:, :, i] = equals_extremum
+    for src, core, dst in tiles:
+        z = np.asarray(im[src])
+        equals_extremum = (filter_func(z, size=size) == z)[core]
 
-    if expanded:
-        is_extremum = is_extremum[:, :, 0]
+        if n_top is None:
+            is_extremum[dst] = equals_extremum
+        else:
+            # Keep only the top candidates of this tile, merged with those found so far
+            tile_ind = np.nonzero(equals_extremum)
+            tile_val = z[core][tile_ind]
+            tile_ind = (tile_ind[0] + dst[0].start, tile_ind[1] + dst[1].start) + tile_ind[2:]
+            ind = tuple(np.concatenate((x, y)) for x, y in zip(ind, tile_ind))
+            val = np.concatenate((val, tile_val))
+            ind, val = _sort_extrema(ind, val, want_maxima, n_top)
 
-    return is_extremum
+    if n_top is None:
+        return is_extremum
+    return ind, val
 
 
-def compute_gradients(im):
+def compute_gradients(im, n_orient_bins=None, cell_size=8):
     """
     Compute magnitudes and orientations of image gradients with Scharr operators
         [ 3 0 -3 ]           [ 3  10  3]
@@ -312,56 +440,480 @@ def compute_gradients(im):
         im: Single-channel (e.g., grayscale) or multi-channel (e.g., RGB) images
             h-by-w or h-by-w-by-c numpy array
             Gradients are computed independently for each of the c channels
+        n_orient_bins: Number of orientation bins for HOG-style histograms of the gradients,
+            binned over unsigned orientations in [0, pi) and weighted by magnitude
+            Positive integer
+            Optional; defaults to None (no histograms)
+        cell_size: Side length of the square cells over which histograms are accumulated;
+            effective only when n_orient_bins is not None; partial cells at the bottom or
+            right border are dropped
+            Positive integer
+            Optional; defaults to 8
 
     Returns:
         grad_mag: Magnitude image of channel gradients; same depth as 'im'
-            Numpy array of the same size as 'im'
+            Float32 (or float64, if 'im' is) numpy array of the same size as 'im'
         grad_orient: Orientation image of channel gradients (in radians)
-            Numpy array of the same size as 'im'
+            Float32 (or float64, if 'im' is) numpy array of the same size as 'im'
                    y ^ pi/2
                      |
             pi       |
              --------+--------> 0
             -pi      |       x
                      | -pi/2
+        orient_hist: Per-cell orientation histograms; returned only if n_orient_bins is not None
+            Float32 numpy array of shape (h // cell_size, w // cell_size, n_orient_bins)
+            or (h // cell_size, w // cell_size, c, n_orient_bins)
     """
-    # Figure out image size and number of channels
-    if im.ndim == 3:
-        h, w, c = im.shape
-        expanded = False
-    elif im.ndim == 2:
-        h, w = im.shape
-        c = 1
-        im = np.expand_dims(im, axis=2) # adds singleton dimension
-        expanded = True
+    if im.ndim not in (2, 3):
+        raise ValueError("'im' must have either two or three dimensions")
+
+    # Float output depth, so that integer images don't saturate
+    ddepth = cv2.CV_64F if im.dtype == np.float64 else cv2.CV_32F
+
+    # All channels at once; Scharr x and y each run exactly once per channel
+    grad_h = cv2.Sobel(im, ddepth, 1, 0, ksize=-1) # 3x3 Scharr, along horizontal direction
+    grad_v = cv2.Sobel(im, ddepth, 0, 1, ksize=-1) # 3x3 Scharr, along vertical direction
+    grad_h = grad_h.reshape(im.shape) # OpenCV drops singleton channel dimensions
+    grad_v = grad_v.reshape(im.shape)
+
+    # Orientation
+    grad_orient = np.arctan2(grad_v, grad_h)
+
+    # Magnitude, reusing the horizontal gradient buffer
+    grad_mag = np.hypot(grad_h, grad_v, out=grad_h)
+    del grad_v
+
+    if n_orient_bins is None:
+        return grad_mag, grad_orient
+
+    orient_hist = _bin_orientations(grad_mag, grad_orient, n_orient_bins, cell_size)
+
+    return grad_mag, grad_orient, orient_hist
+
+
+def _bin_orientations(grad_mag, grad_orient, n_bins, cell_size):
+    """
+    Accumulate magnitude-weighted orientation histograms over square cells, with linear
+        interpolation between the two nearest bins
+    """
+    h, w = grad_mag.shape[:2]
+    n_cells_h, n_cells_w = h // cell_size, w // cell_size
+    if n_cells_h == 0 or n_cells_w == 0:
+        raise ValueError("'cell_size' is larger than the image")
+
+    # Crop to whole cells and flatten to (n_pixels, c)
+    crop = (slice(0, n_cells_h * cell_size), slice(0, n_cells_w * cell_size))
+    mag = grad_mag[crop].reshape(n_cells_h * cell_size, n_cells_w * cell_size, -1)
+    orient = grad_orient[crop].reshape(mag.shape)
+    c = mag.shape[2]
+
+    # Linear index of the cell and channel each pixel falls into
+    rows, cols = np.indices(mag.shape[:2])
+    cell_ind = (rows // cell_size) * n_cells_w + cols // cell_size
+    cell_ch_ind = (cell_ind[:, :, None] * c + np.arange(c)).ravel()
+
+    # Unsigned orientation in bin units, centered on bin centers
+    bin_width = np.pi / n_bins
+    pos = np.mod(orient, np.pi).ravel() / bin_width - 0.5
+    bin_lo = np.floor(pos)
+    frac = pos - bin_lo
+    bin_lo = bin_lo.astype(int) % n_bins
+    bin_hi = (bin_lo + 1) % n_bins
+    mag = mag.ravel()
+
+    n_slots = n_cells_h * n_cells_w * c * n_bins
+    hist = np.bincount(cell_ch_ind * n_bins + bin_lo, weights=mag * (1 - frac), minlength=n_slots)
+    hist += np.bincount(cell_ch_ind * n_bins + bin_hi, weights=mag * frac, minlength=n_slots)
+
+    if grad_mag.ndim == 2:
+        out_shape = (n_cells_h, n_cells_w, n_bins)
     else:
+        out_shape = (n_cells_h, n_cells_w, c, n_bins)
+
+    return hist.reshape(out_shape).astype(np.float32)
+
+
+def process_tiled(im, op, outpath, op_kwargs=None, tile_size=1024, n_workers=None):
+    """
+    Apply an image processing function to an image larger than memory, tile by tile
+        Tiles are read from a memory-mapped input with halos wide enough for the operator's
+        neighborhood, processed in a pool of worker processes, and written into memory-mapped
+        .npy outputs, so the result is identical to processing the whole image at once
+
+    Args:
+        im: Image to process
+            Path to a .npy file (opened memory-mapped), or numpy.memmap of shape h-by-w or h-by-w-by-c
+                (possibly a contiguous view, e.g., a range of rows, of a larger one)
+        op: Function to apply
+            'compute_gradients', 'find_local_extrema', 'binarize', or 'remove_islands'
+        outpath: Path(s) to which the output(s) are written as .npy files; 'compute_gradients'
+            has two outputs (magnitudes and orientations)
+            String or list of strings ending with '.npy'
+        op_kwargs: Keyword parameters for the function (other than the image), e.g.,
+            {'want_maxima': True, 'kernel_size': 5} for 'find_local_extrema';
+            outputs must be per-pixel, so 'n_orient_bins' and 'n_top' are not supported
+            Dictionary of parameter name-value pairs
+            Optional; defaults to None
+        tile_size: Side length(s) of each tile (without halo)
+            Positive integer or 2-tuple thereof
+            Optional; defaults to 1024
+        n_workers: Number of worker processes
+            Positive integer
+            Optional; defaults to None (number of CPUs)
+
+    Returns:
+        out: Output(s), memory-mapped from 'outpath'
+            numpy.memmap or tuple thereof
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    logger.name = thisfile + '->process_tiled()'
+
+    if op_kwargs is None:
+        op_kwargs = {}
+    if isinstance(outpath, str):
+        outpath = [outpath]
+
+    if isinstance(im, str):
+        im = np.load(im, mmap_mode='r')
+    if not isinstance(im, np.memmap):
+        raise TypeError("'im' must be a path to .npy or a numpy.memmap")
+    if im.ndim not in (2, 3):
         raise ValueError("'im' must have either two or three dimensions")
+    im_spec = _memmap_spec(im)
+    h, w = im.shape[:2]
+
+    # Halo derived from the operator's kernel size
+    if op == 'compute_gradients':
+        halo = 1 # 3x3 Scharr
+    elif op == 'find_local_extrema':
+        halo = op_kwargs.get('kernel_size', 3) // 2
+    elif op in ('binarize', 'remove_islands'):
+        halo = 0 # pixel-wise, or connectivity resolved by merging labels across tiles
+    else:
+        raise NotImplementedError(op)
+
+    # Figure out output types and shapes by running the operator on a small crop
+    crop = np.array(im[:min(h, 16), :min(w, 16)])
+    if op == 'remove_islands':
+        probe = (crop,)
+    else:
+        probe = _op_by_name(op)(crop, **op_kwargs)
+        if not isinstance(probe, tuple):
+            probe = (probe,)
+    if any(x.shape[:2] != crop.shape[:2] for x in probe):
+        raise ValueError("Only operators with per-pixel outputs can be run in tiles")
+    assert (len(outpath) == len(probe)), \
+        "'%s' has %d output(s), but %d path(s) are given" % (op, len(probe), len(outpath))
+
+    for path, x in zip(outpath, probe):
+        outdir = dirname(abspath(path))
+        if not exists(outdir):
+            makedirs(outdir, exist_ok=True)
+        np.lib.format.open_memmap(path, mode='w+', dtype=x.dtype, shape=(h, w) + x.shape[2:])
+
+    tiles = list(_iter_tiles(h, w, tile_size, halo))
+
+    logger.info("Processing %d tiles with '%s'", len(tiles), op)
 
-    grad_mag = np.zeros((h, w, c))
-    grad_orient = np.zeros((h, w, c))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        if op == 'remove_islands':
+            _remove_islands_tiled(executor, im_spec, outpath[0], tiles, tile_size, **op_kwargs)
+        else:
+            futures = [executor.submit(_process_tile, op, im_spec, outpath, op_kwargs, *tile)
+                       for tile in tiles]
+            for future in futures:
+                future.result() # re-raises worker errors
 
-    for i in range(c):
-        z = im[:, :, i]
-        ddepth = -1 # same depth as the source
+    logger.info("    ... done")
 
-        # Along horizontal direction
-        xorder, yorder = 1, 0
-        grad_h = cv2.Sobel(z, ddepth, xorder, yorder, ksize=-1) # 3x3 Scharr
-        grad_h = grad_h.astype(float)
+    out = tuple(np.load(path, mmap_mode='r') for path in outpath)
+    if len(out) == 1:
+        return out[0]
+    return out
 
-        # Along vertical direction
-        xorder, yorder = 0, 1
-        grad_v = cv2.Sobel(z, ddepth, xorder, yorder, ksize=-1) # 3x3 Scharr
-        grad_v = grad_v.astype(float)
 
-        # Magnitude
-        grad_mag[:, :, i] = np.sqrt(np.square(grad_h) + np.square(grad_v))
+def _op_by_name(op):
+    if op == 'compute_gradients':
+        return compute_gradients
+    elif op == 'find_local_extrema':
+        return find_local_extrema
+    elif op == 'binarize':
+        return binarize
+    elif op == 'remove_islands':
+        return remove_islands
+    raise NotImplementedError(op)
 
-        # Orientation
-        grad_orient[:, :, i] = np.arctan2(grad_v, grad_h)
 
-    if expanded:
-        grad_mag = grad_mag[:, :, 0]
-        grad_orient = grad_orient[:, :, 0]
+def _memmap_spec(mm):
+    """
+    What a worker process needs to reopen a numpy.memmap, which may be a view (e.g., rows
+        [100:200]) into a larger memory map, as long as it is contiguous
+    """
+    from mmap import ALLOCATIONGRANULARITY
 
-    return grad_mag, grad_orient
+    if mm.flags.c_contiguous:
+        order = 'C'
+    elif mm.flags.f_contiguous:
+        order = 'F'
+    else:
+        raise ValueError("Memory-mapped image must be contiguous, e.g., not a column slice")
+
+    # 'offset' is that of the memory map the view came from; the view's own offset in the file
+    # is how far its data are into the mapping, which starts at an allocation boundary
+    map_start = mm.offset - mm.offset % ALLOCATIONGRANULARITY
+    map_addr = np.frombuffer(mm._mmap, dtype=np.uint8).ctypes.data # pylint: disable=protected-access
+    offset = map_start + mm.ctypes.data - map_addr
+
+    return (mm.filename, mm.dtype, mm.shape, offset, order)
+
+
+def _open_memmap(spec, mode='r'):
+    filename, dtype, shape, offset, order = spec
+    return np.memmap(filename, dtype=dtype, mode=mode, shape=shape, offset=offset, order=order)
+
+
+def _process_tile(op, im_spec, outpath, op_kwargs, src, core, dst):
+    im = _open_memmap(im_spec)
+    res = _op_by_name(op)(np.array(im[src]), **op_kwargs)
+    if not isinstance(res, tuple):
+        res = (res,)
+    for path, x in zip(outpath, res):
+        out = np.load(path, mmap_mode='r+')
+        out[dst] = x[core]
+        out.flush()
+
+
+def _remove_islands_tiled(executor, im_spec, outpath, tiles, tile_size,
+                          min_n_pixels, connectivity=4):
+    """
+    Tiled version of remove_islands(): islands are labeled within each tile, labels that touch
+        across tile borders are merged into global islands, and then small islands are removed
+    """
+    from os import remove
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    assert (connectivity == 4 or connectivity == 8), "'connectivity' must be either 4 or 8"
+    if isinstance(tile_size, int):
+        tile_size = (tile_size, tile_size)
+    h, w = im_spec[2][:2]
+
+    # Tile-local labels, kept on disk next to the output
+    labelpath = outpath[:-len('.npy')] + '_labels.npy'
+    np.lib.format.open_memmap(labelpath, mode='w+', dtype=np.int32, shape=(h, w))
+
+    # Pass 1: label islands within each tile
+    futures = [executor.submit(_label_tile, im_spec, labelpath, connectivity, dst)
+               for _, _, dst in tiles]
+    sizes = [future.result() for future in futures]
+
+    # Offset tile-local labels into a global label space
+    n_labels = np.array([len(x) for x in sizes])
+    bases = np.concatenate(([0], np.cumsum(n_labels)[:-1]))
+    sizes = np.concatenate(sizes)
+    n_tiles_w = -(-w // tile_size[1])
+
+    labelmap = np.load(labelpath, mmap_mode='r')
+
+    def global_labels(rows, cols):
+        local = np.array(labelmap[rows, cols])
+        tile_ind = (np.arange(h)[rows] // tile_size[0]).reshape(-1, 1) * n_tiles_w + \
+            (np.arange(w)[cols] // tile_size[1]).reshape(1, -1)
+        return np.where(local > 0, bases[tile_ind] + local, 0)
+
+    # Pass 2: merge labels of foreground pixels that touch across tile borders
+    pairs = []
+    shifts = (0,) if connectivity == 4 else (-1, 0, 1)
+    for cut in range(tile_size[0], h, tile_size[0]):
+        a = global_labels(slice(cut - 1, cut), slice(0, w)).ravel()
+        b = global_labels(slice(cut, cut + 1), slice(0, w)).ravel()
+        for s in shifts:
+            pairs.append(_touching_pairs(a, b, s))
+    for cut in range(tile_size[1], w, tile_size[1]):
+        a = global_labels(slice(0, h), slice(cut - 1, cut)).ravel()
+        b = global_labels(slice(0, h), slice(cut, cut + 1)).ravel()
+        for s in shifts:
+            pairs.append(_touching_pairs(a, b, s))
+    pairs = np.hstack([np.zeros((2, 0), dtype=int)] + pairs)
+    graph = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])),
+                       shape=(len(sizes), len(sizes)))
+    _, island_ind = connected_components(graph, directed=False)
+    island_sizes = np.bincount(island_ind, weights=sizes)
+    is_small = island_sizes[island_ind] < min_n_pixels
+    del labelmap
+
+    # Pass 3: set small islands to background
+    futures = [executor.submit(_clean_tile, im_spec, labelpath, outpath, is_small, bases[i], dst)
+               for i, (_, _, dst) in enumerate(tiles)]
+    for future in futures:
+        future.result()
+
+    remove(labelpath)
+
+
+def _touching_pairs(a, b, shift):
+    """
+    Label pairs of foreground pixels a[i] and b[i + shift] on two adjacent lines
+    """
+    n = len(a)
+    a = a[max(0, -shift):n - max(0, shift)]
+    b = b[max(0, shift):n - max(0, -shift)]
+    is_pair = (a > 0) & (b > 0)
+    return np.vstack((a[is_pair], b[is_pair]))
+
+
+def _label_tile(im_spec, labelpath, connectivity, dst):
+    im = _open_memmap(im_spec)
+    _, labelmap, stats, _ = cv2.connectedComponentsWithStats(
+        np.array(im[dst], dtype=np.uint8), connectivity=connectivity, ltype=cv2.CV_32S)
+    sizes = stats[:, -1].astype(float)
+    sizes[0] = 0 # background
+    out = np.load(labelpath, mmap_mode='r+')
+    out[dst] = labelmap
+    out.flush()
+    return sizes
+
+
+def _clean_tile(im_spec, labelpath, outpath, is_small, base, dst):
+    im = _open_memmap(im_spec)
+    labelmap = np.load(labelpath, mmap_mode='r')[dst]
+    im_clean = np.array(im[dst])
+    im_clean[(labelmap > 0) & is_small[base + labelmap]] = 0 # background value
+    out = np.load(outpath, mmap_mode='r+')
+    out[dst] = im_clean
+    out.flush()
+
+
+def process_frames(inpaths, ops, outdir, out_ext='.png', n_threads=4, queue_size=16):
+    """
+    Run a chain of image processing functions over many frames, with decoding, processing,
+        and encoding as overlapping stages, each with its own threads, connected by bounded queues
+        (so that an iterator of paths is consumed lazily)
+
+    Args:
+        inpaths: Paths to the input frames, read with cv2.IMREAD_UNCHANGED
+            List or iterator of strings
+        ops: Functions applied in order, each to the output of the previous one
+            List of function names in this module (e.g., 'binarize'), callables, or
+            (name or callable, keyword parameter dictionary) pairs, e.g.,
+            ['binarize', ('remove_islands', {'min_n_pixels': 10}), 'compute_gradients']
+        outdir: Directory to which the outputs are written, named after the input frames
+            String
+        out_ext: Output format; tuple outputs (e.g., from 'compute_gradients') must use '.npz'
+            '.png', '.jpg', etc. (via cv2), '.npy', or '.npz'
+            Optional; defaults to '.png'
+        n_threads: Number of threads per stage
+            Positive integer
+            Optional; defaults to 4
+        queue_size: Maximum number of frames waiting between two stages
+            Positive integer
+            Optional; defaults to 16
+
+    Returns:
+        stats: Per-stage throughput, with keys 'decode', 'process', 'encode' and 'total', each
+            mapping to {'n_frames': ..., 'time': ..., 'fps': ...}; for a stage, 'time' is its
+            worker time summed over threads, so 'fps' is frames per second per thread
+            Dictionary
+    """
+    from os.path import basename, join, splitext
+    from threading import Lock, Thread
+    from queue import Queue
+    from time import time
+
+    logger.name = thisfile + '->process_frames()'
+
+    chain = []
+    for op in ops:
+        func, kwargs = op if isinstance(op, tuple) else (op, {})
+        if isinstance(func, str):
+            func = _op_by_name(func)
+        chain.append((func, kwargs))
+
+    if not exists(outdir):
+        makedirs(outdir, exist_ok=True)
+
+    def decode(path):
+        im = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if im is None:
+            raise IOError("Failed to read %s" % path)
+        return path, im
+
+    def process(item):
+        path, x = item
+        for func, kwargs in chain:
+            x = func(x, **kwargs)
+        return path, x
+
+    def encode(item):
+        path, x = item
+        outpath = join(outdir, splitext(basename(path))[0] + out_ext)
+        if out_ext == '.npz':
+            np.savez(outpath, *(x if isinstance(x, tuple) else (x,)))
+        elif out_ext == '.npy':
+            np.save(outpath, x)
+        elif not cv2.imwrite(outpath, x):
+            raise IOError("Failed to write %s" % outpath)
+
+    stages = [('decode', decode), ('process', process), ('encode', encode)]
+    queues = [Queue(maxsize=queue_size) for _ in stages]
+    stats = {name: {'n_frames': 0, 'time': 0.} for name, _ in stages}
+    lock = Lock()
+    errors = []
+    done = object() # sentinel; each worker consumes one and passes one on
+
+    def feed():
+        try:
+            for path in inpaths:
+                if errors:
+                    break
+                queues[0].put(path)
+        except Exception as e: # pylint: disable=broad-except
+            errors.append(e)
+        finally:
+            # Always, or workers would wait forever
+            for _ in range(n_threads):
+                queues[0].put(done)
+
+    def work(stage_i):
+        name, func = stages[stage_i]
+        is_last = stage_i == len(stages) - 1
+        while True:
+            item = queues[stage_i].get()
+            if item is done:
+                if not is_last:
+                    queues[stage_i + 1].put(done)
+                return
+            if errors:
+                continue # drain without working
+            t0 = time()
+            try:
+                res = func(item)
+            except Exception as e: # pylint: disable=broad-except
+                errors.append(e)
+                continue
+            t = time() - t0
+            with lock:
+                stats[name]['n_frames'] += 1
+                stats[name]['time'] += t
+            if not is_last:
+                queues[stage_i + 1].put(res)
+
+    t0 = time()
+    threads = [Thread(target=feed)] + \
+        [Thread(target=work, args=(i,)) for i in range(len(stages)) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    stats['total'] = {'n_frames': stats['encode']['n_frames'], 'time': time() - t0}
+
+    for name, stat in stats.items():
+        stat['fps'] = stat['n_frames'] / stat['time'] if stat['time'] > 0 else float('inf')
+        logger.info("%s: %d frames in %.2f seconds (%.1f frames/s)",
+                    name, stat['n_frames'], stat['time'], stat['fps'])
+
+    return stats
@@ -5,6 +5,8 @@ Xiuming Zhang, MIT CSAIL
 August 2017
 """
 
+from functools import lru_cache
+from warnings import warn
 import numpy as np
 from scipy.sparse import issparse
 from scipy.sparse.linalg import eigsh
@@ -29,31 +31,156 @@ def smooth_1d(arr, win_size, kernel_type='half'):
         arr_smooth: Smoothed 1D signal
             1D numpy array of floats
     """
-    assert np.mod(win_size, 2) == 1, "Even window size provided"
-    arr = np.array(arr).ravel()
+    return smooth_1d_batch(np.array(arr).ravel(), win_size, kernel_type=kernel_type)
+
 
-    # Generate kernel
+@lru_cache(maxsize=None)
+def _smoothing_kernel(win_size, kernel_type):
+    assert np.mod(win_size, 2) == 1, "Even window size provided"
+    half_size = win_size // 2
     if kernel_type == 'half':
-        kernel = np.array([2 ** x if x < 0 else 2 ** -x
-                           for x in range(-int(win_size / 2), int(win_size / 2) + 1)])
+        kernel = 2. ** -np.abs(np.arange(-half_size, half_size + 1))
     elif kernel_type == 'equal':
         kernel = np.ones(win_size)
     else:
         raise ValueError("Unidentified kernel type")
-    kernel /= sum(kernel)
-    n = (win_size - 1) // 2
+    kernel /= kernel.sum()
+    kernel.flags.writeable = False # shared by all callers
+    return kernel
 
-    arr_pad = np.hstack((arr[0] * np.ones(n), arr, arr[-1] * np.ones(n)))
-    arr_smooth = np.convolve(arr_pad, kernel, 'valid')
 
-    # Restore original values of the head and tail
-    arr_smooth[0] = arr[0]
-    arr_smooth[-1] = arr[-1]
+def smooth_1d_batch(arr, win_size, kernel_type='half', axis=-1):
+    """
+    Smooth many 1D signals at once, e.g., all tracks of a tracker; each signal is smoothed
+        exactly as by smooth_1d(), with kernels cached across calls. Large windows use
+        a cumulative sum ('equal' kernel) or FFT ('half' kernel) instead of direct convolution
+
+    Args:
+        arr: 1D signals to smooth
+            Numpy array of floats, e.g., of shape (n, t)
+        win_size: Size of the smoothing window
+            Odd natural number
+        kernel_type: Kernel type; see smooth_1d()
+            'half' or 'equal'
+            Optional (defaults to 'half')
+        axis: Axis along which the signals run
+            Integer
+            Optional; defaults to -1
 
-    return arr_smooth
+    Returns:
+        arr_smooth: Smoothed signals
+            Numpy array of floats of the same shape as 'arr'
+    """
+    from scipy.ndimage import convolve1d
+    from scipy.signal import fftconvolve
+
+    kernel = _smoothing_kernel(win_size, kernel_type)
+    arr = np.moveaxis(np.asarray(arr, dtype=float), axis, -1)
+    n = (win_size - 1) // 2
 
+    if kernel_type == 'equal' and win_size > 16:
+        # Moving average as difference of cumulative sums: O(t) regardless of window size
+        arr_pad = np.pad(arr, [(0, 0)] * (arr.ndim - 1) + [(n + 1, n)], mode='edge')
+        arr_pad[..., 0] = 0
+        csum = np.cumsum(arr_pad, axis=-1)
+        arr_smooth = (csum[..., win_size:] - csum[..., :-win_size]) / win_size
+    elif win_size > 64:
+        arr_pad = np.pad(arr, [(0, 0)] * (arr.ndim - 1) + [(n, n)], mode='edge')
+        arr_smooth = fftconvolve(arr_pad, kernel.reshape((1,) * (arr.ndim - 1) + (-1,)),
+                                 mode='valid', axes=-1)
+    else:
+        # Padding with the head and tail values
+        arr_smooth = convolve1d(arr, kernel, axis=-1, mode='nearest')
 
-def pca(data_mat, n_pcs=None, eig_method='scipy.sparse.linalg.eigsh'):
+    # Restore original values of the head and tail
+    arr_smooth[..., 0] = arr[..., 0]
+    arr_smooth[..., -1] = arr[..., -1]
+
+    return np.moveaxis(arr_smooth, -1, axis)
+
+
+class StreamingSmoother(object):
+    def __init__(self, win_size, kernel_type='half'):
+        """
+        Online version of smooth_1d() and smooth_1d_batch() for signals arriving one sample at a
+            time (e.g., frame by frame), with the same edge handling; since the window is centered,
+            a smoothed sample comes out (win_size - 1) / 2 samples after its input
+
+        Args:
+            win_size: Size of the smoothing window
+                Odd natural number
+            kernel_type: Kernel type; see smooth_1d()
+                'half' or 'equal'
+                Optional (defaults to 'half')
+        """
+        self.kernel = _smoothing_kernel(win_size, kernel_type)
+        self.win_size = win_size
+        self._buf = None # ring buffer of the latest win_size (padded) samples
+        self._pos = 0 # where the next sample goes in the ring buffer
+        self._n_filled = 0
+        self._n_out = 0
+        self._first = None
+        self._last = None
+
+    def push(self, sample):
+        """
+        Feed the next sample
+
+        Args:
+            sample: Next sample of each signal
+                Float or numpy array of floats, e.g., of shape (n,)
+
+        Returns:
+            smoothed: Smoothed samples that became ready, in order
+                List of zero or one float or numpy array of the same shape as 'sample'
+        """
+        sample = np.array(sample, dtype=float)
+        if self._buf is None:
+            # Pad head with the first value
+            n = (self.win_size - 1) // 2
+            self._buf = np.empty((self.win_size,) + sample.shape)
+            self._buf[:n] = sample
+            self._pos = self._n_filled = n
+            self._first = sample
+        self._last = sample
+        return self._append(sample)
+
+    def flush(self):
+        """
+        Signal the end of the signals and smooth the remaining samples
+
+        Returns:
+            smoothed: Remaining smoothed samples, in order
+                List of floats or numpy arrays
+        """
+        if self._buf is None:
+            return []
+        n = (self.win_size - 1) // 2
+        smoothed = []
+        for _ in range(n):
+            # Pad tail with the last value
+            smoothed += self._append(self._last)
+        if smoothed:
+            smoothed[-1] = self._last # restore tail
+        self._buf = None
+        self._n_out = 0
+        return smoothed
+
+    def _append(self, sample):
+        self._buf[self._pos] = sample
+        self._pos = (self._pos + 1) % self.win_size
+        self._n_filled = min(self._n_filled + 1, self.win_size)
+        if self._n_filled < self.win_size:
+            return []
+        # Kernel aligned with the oldest sample at self._pos; symmetric, so no flipping needed
+        out = np.tensordot(np.roll(self.kernel, self._pos), self._buf, axes=1)
+        if self._n_out == 0:
+            out = self._first # restore head
+        self._n_out += 1
+        return [out]
+
+
+def pca(data_mat, n_pcs=None, eig_method='auto'):
     """
     Perform principal component (PC) analysis on data via eigendecomposition of covariance matrix
         See unit_test() for example usages (incl. reconstructing data with top k PC's)
@@ -63,10 +190,17 @@ def pca(data_mat, n_pcs=None, eig_method='scipy.sparse.linalg.eigsh'):
             Array_like, dense or sparse, of shape (m, n); each column is a point
         n_pcs: Number of top PC's requested
             Positive integer < m
-            Optional; defaults to m - 1
-        eig_method: Method for eigendecomposition of the symmetric covariance matrix
-            'numpy.linalg.eigh' or 'scipy.sparse.linalg.eigsh'
-            Optional; defaults to 'scipy.sparse.linalg.eigsh'
+            Optional; defaults to min(m, n) - 1, as the centered data span no more dimensions, so
+                all further PC's have zero variance
+        eig_method: Method for eigendecomposition of the symmetric covariance matrix;
+            'gram' for eigendecomposition of the n-by-n Gram matrix instead (n_pcs < n);
+            'svd' for thin singular value decomposition of the centered data (n_pcs <= n);
+            'randomized' for randomized_pca(), which never forms the covariance matrix;
+            'auto' for the fastest exact one for the data shape (see _pick_pca_method()),
+                which, for n < m, returns at most the n - 1 PC's of nonzero variance (with a
+                warning if more are requested), instead of forming the m-by-m covariance matrix
+            'numpy.linalg.eigh', 'scipy.sparse.linalg.eigsh', 'gram', 'svd', 'randomized', or 'auto'
+            Optional; defaults to 'auto'
 
     Returns:
         pcvars: PC variances (eigenvalues of covariance matrix) in descending order
@@ -78,18 +212,79 @@ def pca(data_mat, n_pcs=None, eig_method='scipy.sparse.linalg.eigsh'):
         data_mean: Mean that can be used to recover raw data
             Numpy array of length m
     """
-    if issparse(data_mat):
-        data_mat = data_mat.toarray()
-    else:
+    if not issparse(data_mat):
         data_mat = np.array(data_mat)
-    # data_mat is NOT centered
+    # data_mat is NOT centered, and sparse data stay sparse: centering is applied implicitly
 
+    m, n = data_mat.shape
     if n_pcs is None:
-        n_pcs = data_mat.shape[0] - 1
+        n_pcs = min(m, n) - 1
+
+    if eig_method == 'randomized':
+        return randomized_pca(data_mat, n_pcs)
+
+    if eig_method == 'auto':
+        if n < m and n_pcs >= n:
+            # Only the m-by-m covariance matrix has the zero-variance PC's, which would be
+            # unaffordable for, e.g., a few hundred points in a million dimensions
+            warn(("Returning only the %d PC's of nonzero variance; use eig_method="
+                  "'numpy.linalg.eigh' for all %d") % (n - 1, n_pcs))
+            n_pcs = n - 1
+        eig_method = _pick_pca_method(m, n, n_pcs)
+
+    data_mean = np.asarray(data_mat.mean(axis=1), dtype=float).ravel()
+
+    if eig_method == 'gram':
+        # Eigendecomposition of the n-by-n Gram matrix instead of the m-by-m covariance matrix:
+        # if Xc^T Xc v = s^2 v, then Xc v / s is a PC with variance s^2 / (n - 1)
+        assert (n_pcs < n), "'gram' gives at most n - 1 PC's"
+        if issparse(data_mat):
+            # Xc^T Xc = X^T X - a 1^T - 1 a^T + (mean^T mean) 1 1^T, where a = X^T mean,
+            # so that X stays sparse
+            gram = data_mat.T.dot(data_mat).toarray()
+            data_dot_mean = np.asarray(data_mat.T.dot(data_mean)).ravel()
+            gram -= data_dot_mean[:, None] + data_dot_mean[None, :] - data_mean.dot(data_mean)
+        else:
+            # Centered explicitly, as the corrections above lose precision to large offsets
+            data_mat = data_mat - data_mean.reshape(-1, 1)
+            gram = data_mat.T.dot(data_mat)
+        eig_vals, eig_vecs = np.linalg.eigh(gram)
+        # eig_vals in ascending order
+        sing_vals = np.sqrt(np.clip(eig_vals[:-(n_pcs + 1):-1], 0, None)) # descending
+        right_vecs = eig_vecs[:, :-(n_pcs + 1):-1]
+        pcs = np.asarray(data_mat.dot(right_vecs))
+        if issparse(data_mat):
+            pcs -= np.outer(data_mean, right_vecs.sum(axis=0))
+        pcs /= sing_vals
+
+        pcvars = sing_vals ** 2 / (n - 1) # same normalization as np.cov()
+        projs = sing_vals.reshape(-1, 1) * right_vecs.T
+
+        return pcvars, pcs, projs, data_mean
+
+    if eig_method == 'svd':
+        # Thin singular value decomposition of the centered data, which has to be dense
+        assert (n_pcs <= min(m, n)), "'svd' gives at most min(m, n) PC's"
+        if issparse(data_mat):
+            data_mat = data_mat.toarray()
+        left_vecs, sing_vals, right_vecs_t = np.linalg.svd(
+            data_mat - data_mean.reshape(-1, 1), full_matrices=False)
+
+        pcvars = sing_vals[:n_pcs] ** 2 / (n - 1) # same normalization as np.cov()
+        pcs = left_vecs[:, :n_pcs]
+        projs = sing_vals[:n_pcs].reshape(-1, 1) * right_vecs_t[:n_pcs, :]
+
+        return pcvars, pcs, projs, data_mean
 
     # ------ Compute covariance matrix of data
 
-    covmat = np.cov(data_mat) # auto handles uncentered data
+    if issparse(data_mat):
+        # X X^T / (n - 1) - n / (n - 1) mean mean^T, without densifying X
+        covmat = data_mat.dot(data_mat.T).toarray()
+        covmat -= n * np.outer(data_mean, data_mean)
+        covmat /= n - 1
+    else:
+        covmat = np.cov(data_mat) # auto handles uncentered data
     # covmat is real and symmetric in theory, but may not be so due to numerical issues,
     # so eigendecomposition method should be told explicitly to exploit symmetry constraints
 
@@ -121,11 +316,191 @@ def pca(data_mat, n_pcs=None, eig_method='scipy.sparse.linalg.eigsh'):
     else:
         raise NotImplementedError(eig_method)
 
-    # ------ Center and then project data points to PC space
+    # ------ Project data points to PC space, with centering applied implicitly
+
+    projs = _project_centered(data_mat, pcs, data_mean)
+
+    return pcvars, pcs, projs, data_mean
+
+
+def _project_centered(data_mat, pcs, data_mean):
+    """
+    pcs^T (X - mean 1^T), computed as pcs^T X - (pcs^T mean) 1^T, so sparse X stays sparse
+    """
+    if issparse(data_mat):
+        projs = np.asarray(data_mat.T.dot(pcs)).T # sparse matrix on the left
+    else:
+        projs = pcs.T.dot(data_mat)
+    return projs - pcs.T.dot(data_mean).reshape(-1, 1)
+
+
+class PCAModel(object):
+    def __init__(self, data_mat, n_pcs=None, eig_method='auto'):
+        """
+        Principal component (PC) analysis model fitted once with pca(), which can then project
+            and reconstruct new batches of data points without refitting
+
+        Args:
+            data_mat, n_pcs, eig_method: See pca()
+
+        Result attrs:
+            pcvars, pcs, projs, data_mean: See pca()
+        """
+        self.pcvars, self.pcs, self.projs, self.data_mean = \
+            pca(data_mat, n_pcs=n_pcs, eig_method=eig_method)
+
+    def project(self, data_mat):
+        """
+        Center and then project data points to the PC space
+
+        Args:
+            data_mat: Data points
+                Array_like, dense or sparse, of shape (m, k); each column is a point
+
+        Returns:
+            projs: Projections
+                Numpy array of shape (n_pcs, k); each column is a point
+        """
+        if not issparse(data_mat):
+            data_mat = np.asarray(data_mat)
+        return _project_centered(data_mat, self.pcs, self.data_mean)
+
+    def reconstruct(self, projs):
+        """
+        Reconstruct data points from their projections
+
+        Args:
+            projs: Projections
+                Array_like of shape (n_pcs', k), where n_pcs' <= n_pcs, to use only the top PC's
+
+        Returns:
+            data_mat: Reconstructed data points
+                Numpy array of shape (m, k); each column is a point
+        """
+        projs = np.asarray(projs)
+        return self.pcs[:, :projs.shape[0]].dot(projs) + self.data_mean.reshape(-1, 1)
+
+
+def _pick_pca_method(m, n, n_pcs):
+    """
+    Fastest exact PCA method for n points in m-D, according to unit_test('pca_methods'), where
+        n_pcs < n if n < m (see pca()):
+        - n < m: the n-by-n Gram matrix beats the m-by-m covariance matrix by orders of magnitude
+          (e.g., 0.03 vs. 2.6 seconds for m = 5000 and n = 300)
+        - n >= m: the covariance matrix is cheapest, with eigsh() for a few PC's (up to m / 20)
+          and eigh() otherwise
+        Thin SVD of the data is never the fastest (e.g., 3-4x slower than the covariance matrix
+        for n >= m), so it is used only when asked for
+    """
+    if n < m:
+        return 'gram'
+    if 20 * n_pcs <= m:
+        return 'scipy.sparse.linalg.eigsh'
+    return 'numpy.linalg.eigh'
+
+
+def randomized_pca(data_mat, n_pcs, n_oversamples=10, n_power_iters=4, seed=None):
+    """
+    Perform principal component (PC) analysis with randomized singular value decomposition (SVD)
+        of the centered data, without forming the covariance matrix; centering is applied
+        implicitly in every matrix product, so sparse data stay sparse
+
+    Args:
+        data_mat: Data matrix of n data points in the m-D space
+            Array_like, dense or sparse, of shape (m, n); each column is a point
+        n_pcs: Number of top PC's requested
+            Positive integer <= min(m, n)
+        n_oversamples: Number of extra random directions sampled for accuracy
+            Natural number
+            Optional; defaults to 10
+        n_power_iters: Number of power iterations, which help when variances decay slowly
+            Natural number
+            Optional; defaults to 4
+        seed: Seed for the random directions
+            Integer
+            Optional; defaults to None (unseeded)
+
+    Returns:
+        pcvars, pcs, projs, data_mean: Same as those of pca()
+    """
+    if not issparse(data_mat):
+        data_mat = np.asarray(data_mat, dtype=float)
+    m, n = data_mat.shape
+    data_mean = np.asarray(data_mat.mean(axis=1)).ravel()
+
+    # Products with the centered data, X - mean * 1^T
+    def centered_dot(mat):
+        return data_mat.dot(mat) - np.outer(data_mean, mat.sum(axis=0))
+
+    def centered_t_dot(mat):
+        return np.asarray(data_mat.T.dot(mat)) - data_mean.dot(mat)[None, :]
+
+    # Orthonormal basis for the range of centered data, refined with power iterations
+    rng = np.random.RandomState(seed)
+    n_dirs = min(n_pcs + n_oversamples, m, n)
+    q, _ = np.linalg.qr(centered_dot(rng.standard_normal((n, n_dirs))))
+    for _ in range(n_power_iters):
+        q, _ = np.linalg.qr(centered_t_dot(q))
+        q, _ = np.linalg.qr(centered_dot(q))
+
+    # SVD of the small projected matrix
+    u, s, vt = np.linalg.svd(centered_t_dot(q).T, full_matrices=False)
 
-    data_mean = np.mean(data_mat, axis=1)
-    data_mat_centered = data_mat - np.tile(data_mean.reshape(-1, 1), (1, data_mat.shape[1]))
-    projs = np.dot(pcs.T, data_mat_centered)
+    pcvars = s[:n_pcs] ** 2 / (n - 1) # same normalization as np.cov()
+    pcs = q.dot(u[:, :n_pcs])
+    projs = s[:n_pcs, None] * vt[:n_pcs]
+
+    return pcvars, pcs, projs, data_mean
+
+
+def incremental_pca(chunks, n_pcs):
+    """
+    Perform principal component (PC) analysis by streaming over chunks of data points, updating
+        a thin singular value decomposition of the centered data chunk by chunk, so that only
+        one chunk needs to be in memory; data points are then projected in a second pass.
+        Exact when the data have at most n_pcs PC's; otherwise an approximation, since the
+        variance outside the top n_pcs PC's is dropped after every chunk
+
+    Args:
+        chunks: Chunks of data points, each of shape (m, n_i), dense or sparse; each column is a point
+            Sequence (e.g., a list of numpy.memmap slices) or function returning a fresh iterable,
+            since the chunks are visited twice
+        n_pcs: Number of top PC's requested
+            Positive integer <= m
+
+    Returns:
+        pcvars, pcs, projs, data_mean: Same as those of pca()
+    """
+    def iter_chunks(densify=True):
+        for chunk in (chunks() if callable(chunks) else chunks):
+            if issparse(chunk):
+                yield chunk.toarray() if densify else chunk
+            else:
+                yield np.asarray(chunk, dtype=float)
+
+    # Fit, keeping the top singular values and left singular vectors of the centered data so far
+    n_seen = 0
+    for chunk in iter_chunks():
+        n_new = chunk.shape[1]
+        chunk_mean = chunk.mean(axis=1)
+        chunk_centered = chunk - chunk_mean[:, None]
+        if n_seen == 0:
+            data_mean = chunk_mean
+            stacked = chunk_centered
+        else:
+            # Also account for the shift of mean
+            mean_shift = np.sqrt(n_seen * n_new / (n_seen + n_new)) * (data_mean - chunk_mean)
+            stacked = np.hstack((u * s, chunk_centered, mean_shift[:, None]))
+            data_mean = data_mean + (chunk_mean - data_mean) * n_new / (n_seen + n_new)
+        u, s, _ = np.linalg.svd(stacked, full_matrices=False)
+        u, s = u[:, :n_pcs], s[:n_pcs]
+        n_seen += n_new
+
+    pcvars = s ** 2 / (n_seen - 1) # same normalization as np.cov()
+    pcs = u
+
+    # Project
+    projs = np.hstack([_project_centered(chunk, pcs, data_mean) for chunk in iter_chunks(densify=False)])
 
     return pcvars, pcs, projs, data_mean
 
@@ -134,7 +509,7 @@ def matrix_for_discrete_fourier_transform(n):
     """
     Generate transform matrix for discrete Fourier transform (DFT) W
         To transform an image I, apply it twice: WIW
-        See unit_test() for example usages
+        See unit_test() for example usages; DFTOperator applies the same transform with FFT
 
     Args:
         n: Signal length; this will be either image height or width if you are doing 2D DFT
@@ -154,7 +529,97 @@ def matrix_for_discrete_fourier_transform(n):
     return wmat
 
 
-def matrix_for_real_spherical_harmonics(l, n_lat, coord_convention='colatitude-azimuth', _check_orthonormality=False):
+class DFTOperator(object):
+    # Dense matrices materialized so far, keyed by (n, inverse)
+    _dense_cache = {}
+
+    # Make numpy defer 'array @ operator' to __rmatmul__()
+    __array_ufunc__ = None
+
+    def __init__(self, n, inverse=False):
+        """
+        Unitary discrete Fourier transform (DFT) matrix W of matrix_for_discrete_fourier_transform()
+            as a linear operator applied with FFT in O(n log n), instead of a dense O(n ** 2) product.
+            It works with the @ operator like the matrix does, e.g., W_h @ I @ W_w for 2D DFT,
+            where I can also be a stack of images of shape (..., h, w)
+
+        Args:
+            n: Signal length
+                Natural number
+            inverse: Whether this is the inverse (i.e., conjugate transpose) of W
+                Boolean
+                Optional; defaults to False
+        """
+        self.n = n
+        self.inverse = inverse
+
+    @property
+    def shape(self):
+        return (self.n, self.n)
+
+    @property
+    def H(self): # noqa: N802 # pylint: disable=invalid-name
+        """
+        Conjugate transpose, which is also the inverse, since W is unitary
+        DFTOperator
+        """
+        return DFTOperator(self.n, inverse=not self.inverse)
+
+    def _fft(self, x, axis):
+        if x.shape[axis] != self.n:
+            raise ValueError("Expected length %d along axis %d, but got %d" % (self.n, axis, x.shape[axis]))
+        if self.inverse:
+            return np.fft.ifft(x, axis=axis, norm='ortho')
+        return np.fft.fft(x, axis=axis, norm='ortho')
+
+    def dot(self, x):
+        """
+        W.dot(x), i.e., transform a vector, or the columns of (a stack of) matrices
+
+        Args:
+            x: Signal(s)
+                Numpy array of shape (n,) or (..., n, k)
+
+        Returns:
+            coeffs: Numpy complex array of the same shape
+        """
+        x = np.asarray(x)
+        return self._fft(x, 0 if x.ndim == 1 else -2)
+
+    def rdot(self, x):
+        """
+        x.dot(W), i.e., transform a vector, or the rows of (a stack of) matrices; W is symmetric
+
+        Args:
+            x: Signal(s)
+                Numpy array of shape (n,) or (..., k, n)
+
+        Returns:
+            coeffs: Numpy complex array of the same shape
+        """
+        return self._fft(np.asarray(x), -1)
+
+    def __matmul__(self, x):
+        return self.dot(x)
+
+    def __rmatmul__(self, x):
+        return self.rdot(x)
+
+    def toarray(self):
+        """
+        Dense matrix, same as matrix_for_discrete_fourier_transform(n) (or its inverse), cached by n
+
+        Returns:
+            wmat: Numpy complex array of shape (n, n)
+        """
+        key = (self.n, self.inverse)
+        if key not in self._dense_cache:
+            self._dense_cache[key] = self.dot(np.eye(self.n))
+        return self._dense_cache[key]
+
+
+def matrix_for_real_spherical_harmonics(l, n_lat, coord_convention='colatitude-azimuth', dtype=np.float64,
+                                        max_mem_mb=None, out=None, _check_orthonormality=False):
     """
     Generate transform matrix for discrete real spherical harmonic (SH) expansion
         See unit_test() for example usages
@@ -193,6 +658,18 @@ def matrix_for_real_spherical_harmonics(l, n_lat, coord_convention='colatitude-a
                      (pi, 0)                                     |
                                                             (-pi/2, 0)
 
+        dtype: Output type; other than np.float64, the matrix is built block by block (see below)
+            np.float32 or np.float64
+            Optional; defaults to np.float64
+        max_mem_mb: Memory budget; if set, the matrix is built block by block from the separable
+            factors of SH's (see RealSphericalHarmonicsTransform), in blocks of rows no larger than
+            this, without the dense angle and complex SH matrices
+            Positive float
+            Optional; defaults to None (no budget)
+        out: Where to write the matrix, e.g., a numpy.memmap for matrices larger than memory;
+            if set, the matrix is built block by block, in its dtype
+            Numpy array of shape ((l + 1) ** 2, 2 * n_lat ** 2)
+            Optional; defaults to None (allocate one)
         _check_orthonormality: Whether to check orthonormality or not
             Boolean
             Internal use only and optional; defaults to False
@@ -210,6 +687,11 @@ def matrix_for_real_spherical_harmonics(l, n_lat, coord_convention='colatitude-a
             Flattened also in row-major order
             Numpy array of length n_lat * (2 * n_lat)
     """
+    if max_mem_mb is not None or out is not None or np.dtype(dtype) != np.float64:
+        assert not _check_orthonormality, "Orthonormality is checked only when building all at once"
+        return _matrix_for_real_spherical_harmonics_blockwise(
+            l, n_lat, coord_convention, dtype, max_mem_mb, out)
+
     # Generate the l and m values for each matrix location
     l_mat = np.zeros(((l + 1) ** 2, n_lat * 2 * n_lat))
     m_mat = np.zeros(l_mat.shape)
@@ -221,20 +703,7 @@ def matrix_for_real_spherical_harmonics(l, n_lat, coord_convention='colatitude-a
             i += 1
 
     # Generate the two angles for each matrix location
-    step_size = np.pi / n_lat
-    if coord_convention == 'colatitude-azimuth':
-        azis, colats = np.meshgrid(
-            np.linspace(0 + step_size, 2 * np.pi - step_size, num=2 * n_lat, endpoint=True),
-            np.linspace(0 + step_size, np.pi - step_size, num=n_lat, endpoint=True))
-    elif coord_convention == 'latitude-longitude':
-        lngs, lats = np.meshgrid(
-            np.linspace(-np.pi + step_size, np.pi - step_size, num=2 * n_lat, endpoint=True),
-            np.linspace(np.pi / 2 - step_size, -np.pi / 2 + step_size, num=n_lat, endpoint=True))
-        colats = np.pi / 2 - lats
-        azis = lngs
-        azis[azis < 0] += 2 * np.pi
-    else:
-        raise NotImplementedError(coord_convention)
+    azis, colats = np.meshgrid(*_sh_grid_angles(n_lat, coord_convention)[::-1])
 
     # Evaluate (complex) SH at these locations
     colat_mat = np.tile(colats.ravel(), (l_mat.shape[0], 1))
@@ -299,6 +768,487 @@ def matrix_for_real_spherical_harmonics(l, n_lat, coord_convention='colatitude-a
     return ymat, areas_on_unit_sphere
 
 
+def _matrix_for_real_spherical_harmonics_blockwise(l, n_lat, coord_convention, dtype, max_mem_mb, out):
+    """
+    matrix_for_real_spherical_harmonics() in blocks of rows, each row being the outer product of
+        a colatitude factor and an azimuth factor, written directly into the output
+    """
+    n_harmonics, n_samples = (l + 1) ** 2, 2 * n_lat ** 2
+    if out is None:
+        out = np.empty((n_harmonics, n_samples), dtype=dtype)
+    elif out.shape != (n_harmonics, n_samples):
+        raise ValueError("'out' must be of shape (%d, %d)" % (n_harmonics, n_samples))
+    if not out.flags.c_contiguous:
+        raise ValueError("'out' must be C-contiguous, so that blocks of rows can be written in place")
+    dtype = out.dtype
+
+    colats, azis = _sh_grid_angles(n_lat, coord_convention)
+    colat_factors = _real_sh_colat_factors(l, colats, dtype=dtype)
+    azi_factors = _real_sh_azi_factors(l, azis, dtype=dtype)
+    m_ind = np.hstack([np.arange(-curr_l, curr_l + 1) for curr_l in range(l + 1)]) + l
+
+    if max_mem_mb is None:
+        n_rows = n_harmonics
+    else:
+        n_rows = max(1, int(max_mem_mb * 2 ** 20 // (n_samples * dtype.itemsize)))
+
+    for start in range(0, n_harmonics, n_rows):
+        rows = slice(start, min(start + n_rows, n_harmonics))
+        block = out[rows].reshape(-1, n_lat, 2 * n_lat) # view of the output
+        np.multiply(colat_factors[rows, :, None], azi_factors[m_ind[rows], None, :], out=block)
+        if isinstance(out, np.memmap):
+            out.flush() # so that written blocks can leave memory
+
+    # Only n_lat distinct values, one per row of the spherical function image
+    areas_on_unit_sphere = np.repeat(_sh_row_areas(colats, len(azis)), len(azis)).astype(dtype)
+
+    return out, areas_on_unit_sphere
+
+
+def _sh_row_areas(colats, n_azis):
+    """
+    Area on the unit sphere covered by each sample point in each row of the spherical function
+        image, proportional to sin(colat), as in matrix_for_real_spherical_harmonics()
+    """
+    sin_colat = np.sin(colats)
+    return 4 * np.pi * sin_colat / (np.sum(sin_colat) * n_azis)
+
+
+def _sh_grid_angles(n_lat, coord_convention):
+    """
+    Colatitudes of the rows and azimuths of the columns of the spherical function image
+        used by matrix_for_real_spherical_harmonics()
+    """
+    step_size = np.pi / n_lat
+    if coord_convention == 'colatitude-azimuth':
+        azis = np.linspace(0 + step_size, 2 * np.pi - step_size, num=2 * n_lat, endpoint=True)
+        colats = np.linspace(0 + step_size, np.pi - step_size, num=n_lat, endpoint=True)
+    elif coord_convention == 'latitude-longitude':
+        lngs = np.linspace(-np.pi + step_size, np.pi - step_size, num=2 * n_lat, endpoint=True)
+        lats = np.linspace(np.pi / 2 - step_size, -np.pi / 2 + step_size, num=n_lat, endpoint=True)
+        colats = np.pi / 2 - lats
+        azis = lngs
+        azis[azis < 0] += 2 * np.pi
+    else:
+        raise NotImplementedError(coord_convention)
+    return colats, azis
+
+
+def _real_sh_colat_factors(l, colats, dtype=np.float64):
+    """
+    Colatitude-dependent factors of real SH's, i.e., normalized associated Legendre functions
+        computed with the stable three-term recurrence, with the same normalization and signs as
+        matrix_for_real_spherical_harmonics()
+
+    Args:
+        l: Up to which band
+            Natural number
+        colats: Colatitudes
+            1D numpy array of length n
+        dtype: Output type
+            Numpy float type
+            Optional; defaults to np.float64
+
+    Returns:
+        factors: Row i = (l + 1) * l + m, when multiplied with row m + l of _real_sh_azi_factors(),
+            gives the i-th real SH
+            Numpy array of shape ((l + 1) ** 2, n)
+    """
+    x = np.cos(colats).astype(dtype)
+    y = np.sin(colats).astype(dtype)
+    factors = np.empty(((l + 1) ** 2, len(x)), dtype=dtype)
+
+    def store(curr_l, m, p):
+        i = curr_l * (curr_l + 1)
+        if m == 0:
+            factors[i] = p
+        else:
+            factors[i + m] = np.sqrt(2) * p
+            factors[i - m] = (-1) ** (m + 1) * np.sqrt(2) * p
+
+    p_mm = np.full(len(x), np.sqrt(1 / (4 * np.pi)), dtype=dtype)
+    for m in range(l + 1):
+        if m > 0:
+            p_mm = np.sqrt((2 * m + 1) / (2 * m)) * y * p_mm
+        store(m, m, p_mm)
+        if m == l:
+            break
+        p_prev2, p_prev = p_mm, np.sqrt(2 * m + 3) * x * p_mm
+        store(m + 1, m, p_prev)
+        for curr_l in range(m + 2, l + 1):
+            a = np.sqrt((4 * curr_l ** 2 - 1) / (curr_l ** 2 - m ** 2))
+            b = np.sqrt(((curr_l - 1) ** 2 - m ** 2) / (4 * (curr_l - 1) ** 2 - 1))
+            p = a * (x * p_prev - b * p_prev2)
+            store(curr_l, m, p)
+            p_prev2, p_prev = p_prev, p
+
+    return factors
+
+
+def _real_sh_azi_factors(l, azis, dtype=np.float64):
+    """
+    Azimuth-dependent factors of real SH's: row m + l is sin(|m| * azi) for m < 0, 1 for m = 0,
+        and cos(m * azi) for m > 0
+
+    Returns:
+        factors: Numpy array of shape (2 * l + 1, n)
+    """
+    angles = np.arange(1, l + 1, dtype=dtype).reshape(-1, 1) * \
+        np.asarray(azis, dtype=dtype).reshape(1, -1) # |m| * azi for m = 1, ..., l
+    factors = np.empty((2 * l + 1, angles.shape[1]), dtype=dtype)
+    factors[:l] = np.sin(angles[::-1])
+    factors[l] = 1
+    factors[(l + 1):] = np.cos(angles)
+    return factors
+
+
+def real_spherical_harmonics(l, dirs, coord_convention='colatitude-azimuth', dtype=np.float64,
+                             chunk_size=65536):
+    """
+    Evaluate real spherical harmonics (SH) at arbitrary directions, with the same harmonics
+        (normalization, signs, and ordering) as matrix_for_real_spherical_harmonics()
+
+    Args:
+        l: Up to which band (starting form 0); the number of harmonics is (l + 1) ** 2
+            Natural number
+        dirs: Directions
+            Numpy array of shape (n, 3) (unit vectors) or (n, 2) (angles in radians, following
+            'coord_convention'); see matrix_for_real_spherical_harmonics() for the axes
+        coord_convention: Convention of angle inputs; ignored for unit vectors
+            'colatitude-azimuth' or 'latitude-longitude'
+            Optional; defaults to 'colatitude-azimuth'
+        dtype: Output type
+            np.float32 or np.float64
+            Optional; defaults to np.float64
+        chunk_size: Number of directions evaluated at once, to bound the size of temporaries
+            Positive integer
+            Optional; defaults to 65536
+
+    Returns:
+        ymat: Row i gives the values of the i-th harmonic, where i = (l + 1) * l + m
+            Numpy array of shape ((l + 1) ** 2, n)
+    """
+    dirs = np.asarray(dirs)
+    if dirs.ndim != 2 or dirs.shape[1] not in (2, 3):
+        raise ValueError("'dirs' must be of shape (n, 2) or (n, 3)")
+
+    # To colatitudes and azimuths
+    if dirs.shape[1] == 3:
+        colats = np.arccos(np.clip(dirs[:, 2], -1, 1))
+        azis = np.arctan2(dirs[:, 1], dirs[:, 0])
+    elif coord_convention == 'colatitude-azimuth':
+        colats, azis = dirs[:, 0], dirs[:, 1]
+    elif coord_convention == 'latitude-longitude':
+        colats, azis = np.pi / 2 - dirs[:, 0], dirs[:, 1]
+    else:
+        raise NotImplementedError(coord_convention)
+
+    ms = np.hstack([np.arange(-curr_l, curr_l + 1) for curr_l in range(l + 1)])
+
+    ymat = np.empty(((l + 1) ** 2, dirs.shape[0]), dtype=dtype)
+    for start in range(0, dirs.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        ymat[:, chunk] = _real_sh_colat_factors(l, colats[chunk], dtype=dtype)
+        ymat[:, chunk] *= _real_sh_azi_factors(l, azis[chunk], dtype=dtype)[ms + l]
+
+    return ymat
+
+
+def sh_rotation_matrices(l, rot_mats):
+    """
+    Per-band rotation matrices of real spherical harmonic (SH) coefficients, built from the 3D
+        rotations with the Ivanic-Ruedenberg recurrence, batched over many rotations; if f has
+        coefficients c, then f rotated by R, i.e., f(R^T x), has coefficients
+        [bands[0] c_0, bands[1] c_1, ..., bands[l] c_l], where c_k are the 2k + 1 coefficients
+        of band k (see rotate_sh())
+
+    Args:
+        l: Up to which band
+            Natural number
+        rot_mats: Rotation matrices
+            Numpy array of shape (3, 3) or (b, 3, 3)
+
+    Returns:
+        bands: Rotation matrix of each band, for harmonics of the same order as those of
+            matrix_for_real_spherical_harmonics()
+            List of l + 1 numpy arrays of shape (2 * k + 1, 2 * k + 1) or (b, 2 * k + 1, 2 * k + 1)
+            for band k
+    """
+    rot_mats = np.asarray(rot_mats, dtype=float)
+    is_single = rot_mats.ndim == 2
+    if is_single:
+        rot_mats = rot_mats[None, :, :]
+    b = rot_mats.shape[0]
+
+    bands = [np.ones((b, 1, 1))]
+    if l >= 1:
+        # Band 1 harmonics are proportional to (y, z, x)
+        yzx = [1, 2, 0]
+        r1 = rot_mats[:, yzx, :][:, :, yzx]
+        bands.append(r1)
+
+    for curr_l in range(2, l + 1):
+        prev = bands[-1]
+
+        def p_row(i, a):
+            """
+            P of the recurrence for all n at once; i in (-1, 0, 1), |a| < curr_l
+            """
+            prev_row = prev[:, a + curr_l - 1, :]
+            row = np.empty((b, 2 * curr_l + 1))
+            row[:, 1:-1] = r1[:, i + 1, 1:2] * prev_row
+            row[:, -1] = r1[:, i + 1, 2] * prev_row[:, -1] - r1[:, i + 1, 0] * prev_row[:, 0]
+            row[:, 0] = r1[:, i + 1, 2] * prev_row[:, 0] + r1[:, i + 1, 0] * prev_row[:, -1]
+            return row
+
+        ns = np.arange(-curr_l, curr_l + 1)
+        denom = np.where(np.abs(ns) == curr_l, 2 * curr_l * (2 * curr_l - 1),
+                         (curr_l + ns) * (curr_l - ns)).astype(float)
+        band = np.empty((b, 2 * curr_l + 1, 2 * curr_l + 1))
+        for m in range(-curr_l, curr_l + 1):
+            abs_m, d = abs(m), float(m == 0)
+            u = np.sqrt((curr_l + m) * (curr_l - m) / denom)
+            v = 0.5 * np.sqrt((1 + d) * (curr_l + abs_m - 1) * (curr_l + abs_m) / denom) * (1 - 2 * d)
+            w = -0.5 * np.sqrt((curr_l - abs_m - 1) * (curr_l - abs_m) / denom) * (1 - d)
+
+            row = u * p_row(0, m) if abs_m < curr_l else 0
+            if m == 0:
+                row = row + v * (p_row(1, 1) + p_row(-1, -1))
+            elif m > 0:
+                row = row + v * (p_row(1, m - 1) * np.sqrt(1 + (m == 1)) - (m != 1) * p_row(-1, -m + 1))
+            else:
+                row = row + v * ((m != -1) * p_row(1, m + 1) + p_row(-1, -m - 1) * np.sqrt(1 + (m == -1)))
+            if abs_m < curr_l - 1:
+                if m > 0:
+                    row = row + w * (p_row(1, m + 1) + p_row(-1, -m - 1))
+                elif m < 0:
+                    row = row + w * (p_row(1, m - 1) - p_row(-1, -m + 1))
+            band[:, m + curr_l, :] = row
+        bands.append(band)
+
+    # The recurrence is for real SH's whose m < 0 harmonics are all positive multiples of
+    # sin(|m| * azi); ours have an extra sign of (-1) ** (|m| + 1)
+    for curr_l in range(2, l + 1):
+        signs = np.ones(2 * curr_l + 1)
+        signs[:curr_l] = (-1) ** (np.arange(curr_l, 0, -1) + 1)
+        bands[curr_l] = bands[curr_l] * signs[:, None] * signs[None, :]
+
+    if is_single:
+        bands = [x[0] for x in bands]
+    return bands
+
+
+def rotate_sh(coeffs, rot_mats):
+    """
+    Rotate spherical functions represented by real spherical harmonic (SH) coefficients,
+        without resampling the functions
+
+    Args:
+        coeffs: SH coefficients of the function(s)
+            Numpy array of shape (..., (l + 1) ** 2)
+        rot_mats: Rotations, or per-band matrices precomputed by sh_rotation_matrices()
+            Numpy array of shape (3, 3) or (b, 3, 3), or list of per-band matrices
+
+    Returns:
+        coeffs_rot: SH coefficients of the rotated function(s), i.e., f(R^T x); with b rotations,
+            there is an extra leading dimension of size b
+            Numpy array of shape (..., (l + 1) ** 2) or (b, ..., (l + 1) ** 2)
+    """
+    coeffs = np.asarray(coeffs)
+    l = int(np.sqrt(coeffs.shape[-1])) - 1
+    if isinstance(rot_mats, list):
+        bands = rot_mats
+    else:
+        bands = sh_rotation_matrices(l, rot_mats)
+
+    coeffs_rot = []
+    for curr_l, band in enumerate(bands[:(l + 1)]):
+        coeffs_band = coeffs[..., (curr_l ** 2):((curr_l + 1) ** 2)]
+        if band.ndim == 2:
+            coeffs_rot.append(np.einsum('ij,...j->...i', band, coeffs_band))
+        else:
+            # Rotations vary the slowest
+            coeffs_rot.append(np.einsum('bij,...j->b...i', band, coeffs_band))
+    return np.concatenate(coeffs_rot, axis=-1)
+
+
+def zonal_harmonic_coeffs(lobe, l, n_samples=256):
+    """
+    Zonal harmonic (i.e., m = 0 SH) coefficients of a function symmetric about the z-axis,
+        such as a BRDF lobe, by Gauss-Legendre quadrature
+
+    Args:
+        lobe: Function of cosine of the colatitude, e.g., lambda x: np.clip(x, 0, None) (clamped cosine)
+            Vectorized callable
+        l: Up to which band
+            Natural number
+        n_samples: Number of quadrature nodes; must be large enough for non-smooth lobes
+            Positive integer
+            Optional; defaults to 256
+
+    Returns:
+        zh_coeffs: Coefficient of each band
+            Numpy array of length l + 1
+    """
+    nodes, weights = np.polynomial.legendre.leggauss(n_samples)
+    m0_rows = [curr_l * (curr_l + 1) for curr_l in range(l + 1)]
+    y_l0 = _real_sh_colat_factors(l, np.arccos(nodes))[m0_rows]
+    # Integral over the sphere = 2pi * integral over cos(colat) in [-1, 1]
+    return 2 * np.pi * y_l0.dot(weights * lobe(nodes))
+
+
+def convolve_sh(coeffs, zh_coeffs):
+    """
+    Convolve spherical functions with a kernel symmetric about the z-axis (e.g., a BRDF lobe),
+        directly on real spherical harmonic (SH) coefficients (Funk-Hecke theorem): every
+        coefficient of band k is scaled by sqrt(4pi / (2k + 1)) times the kernel's k-th zonal
+        harmonic coefficient
+
+    Args:
+        coeffs: SH coefficients of the function(s)
+            Numpy array of shape (..., (l + 1) ** 2)
+        zh_coeffs: Zonal harmonic coefficients of the kernel, e.g., from zonal_harmonic_coeffs()
+            Numpy array of length >= l + 1, or of shape (b, >= l + 1) for b kernels
+
+    Returns:
+        coeffs_conv: SH coefficients of the convolved function(s); with b kernels, there is
+            an extra leading dimension of size b
+            Numpy array of shape (..., (l + 1) ** 2) or (b, ..., (l + 1) ** 2)
+    """
+    coeffs = np.asarray(coeffs)
+    zh_coeffs = np.asarray(zh_coeffs)
+    l = int(np.sqrt(coeffs.shape[-1])) - 1
+
+    band_ind = np.repeat(np.arange(l + 1), 2 * np.arange(l + 1) + 1)
+    scales = np.sqrt(4 * np.pi / (2 * band_ind + 1)) * zh_coeffs[..., band_ind]
+    if scales.ndim == 1:
+        return coeffs * scales
+    return coeffs[None, ...] * scales.reshape((-1,) + (1,) * (coeffs.ndim - 1) + (scales.shape[-1],))
+
+
+class RealSphericalHarmonicsTransform(object):
+    # Separable factors already computed in this process, keyed by (l, n_lat, coord_convention)
+    _cache = {}
+
+    def __init__(self, l, n_lat, coord_convention='colatitude-azimuth', cache_dir=None):
+        """
+        Discrete real spherical harmonic (SH) transform on the same grid and with the same
+            harmonics as matrix_for_real_spherical_harmonics(), but without the dense matrix:
+            each harmonic is a colatitude factor (associated Legendre function) times an azimuth
+            factor (sine or cosine), so analysis and synthesis cost O(l * n_lat ** 2) instead of
+            O(l ** 2 * n_lat ** 2). The factors are cached in memory and optionally on disk
+
+        Args:
+            l: Up to which band (starting form 0); the number of harmonics is (l + 1) ** 2
+                Natural number
+            n_lat: Number of discretization levels of colatitude or latitude;
+                the spherical function image is n_lat-by-(2 * n_lat)
+                Natural number
+            coord_convention: Coordinate system convention to use
+                'colatitude-azimuth' or 'latitude-longitude'
+                See matrix_for_real_spherical_harmonics()
+                Optional; defaults to 'colatitude-azimuth'
+            cache_dir: Directory in which the factors are cached across processes
+                String
+                Optional; defaults to None (in-memory caching only)
+        """
+        self.l = l
+        self.n_lat = n_lat
+        self.coord_convention = coord_convention
+
+        key = (l, n_lat, coord_convention)
+        if key not in self._cache:
+            self._cache[key] = self._load_or_compute(cache_dir)
+        self.colat_factors, self.azi_factors, self.row_areas = self._cache[key]
+
+        # Harmonic index i = (l + 1) * l + m, grouped by m for synthesis
+        ms = np.hstack([np.arange(-curr_l, curr_l + 1) for curr_l in range(l + 1)])
+        self._m_ind = ms + l # row of azi_factors for each harmonic
+        self._by_m = np.argsort(self._m_ind, kind='stable')
+        self._m_starts = np.searchsorted(self._m_ind[self._by_m], np.arange(2 * l + 1))
+
+    def _load_or_compute(self, cache_dir):
+        if cache_dir is not None:
+            from os import makedirs
+            from os.path import exists, join
+            cache_path = join(cache_dir, 'real_sh_l%d_nlat%d_%s.npz' % (
+                self.l, self.n_lat, self.coord_convention))
+            if exists(cache_path):
+                data = np.load(cache_path)
+                return data['colat_factors'], data['azi_factors'], data['row_areas']
+
+        colats, azis = _sh_grid_angles(self.n_lat, self.coord_convention)
+        colat_factors = _real_sh_colat_factors(self.l, colats)
+        azi_factors = _real_sh_azi_factors(self.l, azis)
+        row_areas = _sh_row_areas(colats, len(azis))
+
+        if cache_dir is not None:
+            if not exists(cache_dir):
+                makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_path, colat_factors=colat_factors, azi_factors=azi_factors,
+                     row_areas=row_areas)
+
+        return colat_factors, azi_factors, row_areas
+
+    @property
+    def areas_on_unit_sphere(self):
+        """
+        Same as that returned by matrix_for_real_spherical_harmonics()
+        Numpy array of length n_lat * (2 * n_lat)
+        """
+        return np.repeat(self.row_areas, 2 * self.n_lat)
+
+    @property
+    def ymat(self):
+        """
+        Dense transform matrix, same as that returned by matrix_for_real_spherical_harmonics();
+            materialized only when asked for
+        Numpy array of shape ((l + 1) ** 2, 2 * n_lat ** 2)
+        """
+        ymat = self.colat_factors[:, :, None] * self.azi_factors[self._m_ind][:, None, :]
+        return ymat.reshape(ymat.shape[0], -1)
+
+    def analyze(self, sph_func):
+        """
+        Compute SH coefficients of spherical function(s)
+
+        Args:
+            sph_func: Spherical function(s) as image(s) indexed by two angles
+                Numpy array of shape (..., n_lat, 2 * n_lat)
+
+        Returns:
+            coeffs: SH coefficients, same as ymat.dot(areas_on_unit_sphere * sph_func.ravel())
+                Numpy array of shape (..., (l + 1) ** 2)
+        """
+        # Project each row onto the azimuth factors, then weight rows by their areas
+        proj = np.matmul(sph_func, self.azi_factors.T) # (..., n_lat, 2 * l + 1)
+        proj *= self.row_areas[:, None]
+
+        # Integrate over colatitude for each harmonic
+        proj = proj[..., self._m_ind] # (..., n_lat, (l + 1) ** 2)
+        return np.einsum('...ri,ir->...i', proj, self.colat_factors)
+
+    def synthesize(self, coeffs):
+        """
+        Reconstruct spherical function(s) from SH coefficients
+
+        Args:
+            coeffs: SH coefficients
+                Numpy array of shape (..., (l + 1) ** 2)
+
+        Returns:
+            sph_func: Spherical function(s), same as ymat.T.dot(coeffs) reshaped
+                Numpy array of shape (..., n_lat, 2 * n_lat)
+        """
+        coeffs = np.asarray(coeffs)
+
+        # Sum colatitude factors of harmonics sharing the same m
+        weighted = coeffs[..., None, self._by_m] * self.colat_factors[self._by_m].T
+        per_m = np.add.reduceat(weighted, self._m_starts, axis=-1) # (..., n_lat, 2 * l + 1)
+
+        return np.matmul(per_m, self.azi_factors)
+
+
 def unit_test(func_name):
     # Unit tests and example usages
 
@@ -315,6 +1265,28 @@ def unit_test(func_name):
             np.tile(data_mean, (projs.shape[1], 1)).T
         pdb.set_trace()
 
+    elif func_name == 'pca_methods':
+        from time import time
+
+        # (m, n, n_pcs): n points in m-D
+        shapes = [(200, 2000, 10), (1000, 1000, 10), (1000, 1000, 500), (2000, 4000, 10),
+                  (2000, 4000, 200), (2000, 500, 10), (5000, 300, 10), (5000, 300, 299)]
+        methods = ['scipy.sparse.linalg.eigsh', 'numpy.linalg.eigh', 'gram', 'svd']
+
+        print("(m, n, n_pcs)\t" + "\t".join(methods) + "\tauto picks")
+        for m, n, n_pcs in shapes:
+            pts = np.random.rand(m, n)
+            times = []
+            for eig_method in methods:
+                if eig_method == 'gram' and n_pcs >= n:
+                    times.append("n/a")
+                    continue
+                t0 = time()
+                pca(pts, n_pcs=n_pcs, eig_method=eig_method)
+                times.append("%.3f" % (time() - t0))
+            print("(%d, %d, %d)\t" % (m, n, n_pcs) + "\t".join(times) +
+                  "\t" + _pick_pca_method(m, n, n_pcs))
+
     elif func_name == 'matrix_for_discrete_fourier_transform':
         im = np.random.randint(0, 255, (8, 10))
         h, w = im.shape
@@ -330,6 +1302,21 @@ def unit_test(func_name):
         print("%s: max. magnitude difference: %e" % (func_name, np.abs(coeffs - coeffs_np).max()))
         pdb.set_trace()
 
+    elif func_name == 'DFTOperator':
+        ims = np.random.randint(0, 255, (3, 8, 10))
+        h, w = ims.shape[1:]
+
+        # Transform a stack of images, as with matrices
+        coeffs = DFTOperator(h) @ ims @ DFTOperator(w)
+
+        # Transform back
+        ims_recon = DFTOperator(h).H @ coeffs @ DFTOperator(w).H
+
+        print("%s: max. coefficient difference: %e; max. reconstruction difference: %e" % (
+            func_name, np.abs(coeffs - np.fft.fft2(ims) / np.sqrt(h * w)).max(),
+            np.abs(ims_recon - ims).max()))
+        pdb.set_trace()
+
     elif func_name == 'matrix_for_real_spherical_harmonics':
         from visualization import matrix_as_heatmap
 
@@ -358,6 +1345,24 @@ def unit_test(func_name):
             matrix_as_heatmap(sph_func_recon, outpath='../../test-output/recon_l%03d.png' % l)
         pdb.set_trace()
 
+    elif func_name == 'RealSphericalHarmonicsTransform':
+        l, n_steps_theta = 10, 100
+        sph_func = np.random.rand(n_steps_theta, 2 * n_steps_theta)
+
+        # Transform with the dense matrix
+        ymat, weights = matrix_for_real_spherical_harmonics(l, n_steps_theta)
+        coeffs = ymat.dot(np.multiply(weights, sph_func.ravel()))
+
+        # Transform with separable factors
+        sht = RealSphericalHarmonicsTransform(l, n_steps_theta)
+        coeffs_sep = sht.analyze(sph_func)
+        recon_sep = sht.synthesize(coeffs_sep)
+
+        print("%s: max. coefficient difference: %e; max. reconstruction difference: %e" % (
+            func_name, np.abs(coeffs - coeffs_sep).max(),
+            np.abs(ymat.T.dot(coeffs) - recon_sep.ravel()).max()))
+        pdb.set_trace()
+
     else:
         raise NotImplementedError("Unit tests for %s" % func_name)
 
@@ -6,7 +6,8 @@ June 2017
 """
 
 from os import makedirs
-from os.path import dirname, exists
+from os.path import basename, dirname, exists, splitext
+from functools import lru_cache
 from warnings import warn
 from pickle import dump
 import numpy as np
@@ -148,9 +149,330 @@ def pyplot_wrapper(*args,
     plt.close('all')
 
 
+class ReusablePlot(object):
+    def __init__(self,
+                 func='plot',
+                 labels=None,
+                 legend_fontsize=20,
+                 legend_loc=0,
+                 figsize=(14, 14),
+                 figtitle=None,
+                 figtitle_fontsize=20,
+                 xlabel=None,
+                 xlabel_fontsize=20,
+                 ylabel=None,
+                 ylabel_fontsize=20,
+                 xlim=None,
+                 ylim=None,
+                 grid=True,
+                 center_around_zero=False,
+                 **kwargs):
+        """
+        Figure and axes that stay alive across many saves, for dumping many plots of the same
+            kind (e.g., one per iteration): artists are created on the first save, and only
+            their data are updated afterwards, with layout computed only once. Use it as a
+            context manager, or call close() when done
+
+        Args:
+            func: What to plot
+                'plot' (like pyplot_wrapper()), 'scatter', or 'heatmap' (like matrix_as_heatmap())
+                Optional; defaults to 'plot'
+            labels, legend_fontsize, legend_loc, figsize, figtitle, figtitle_fontsize, xlabel,
+                xlabel_fontsize, ylabel, ylabel_fontsize, xlim, ylim, grid: See pyplot_wrapper()
+            center_around_zero: See matrix_as_heatmap(); effective only for 'heatmap'
+                Boolean
+                Optional; defaults to False
+            **kwargs: Keyword parameters for the plotting function, e.g., 'color' or 'cmap'
+        """
+        if func not in ('plot', 'scatter', 'heatmap'):
+            raise NotImplementedError(func)
+        self.func = func
+        self.labels = labels
+        self.legend_fontsize = legend_fontsize
+        self.legend_loc = legend_loc
+        self.xlim = xlim
+        self.ylim = ylim
+        self.center_around_zero = center_around_zero
+        self.kwargs = kwargs
+
+        self.fig = plt.figure(figsize=figsize)
+        self.ax = self.fig.gca()
+        if figtitle is not None:
+            self.ax.set_title(figtitle, fontsize=figtitle_fontsize)
+        if func != 'heatmap':
+            self.ax.grid(grid)
+        if xlim is not None:
+            self.ax.set_xlim(left=xlim[0], right=xlim[1])
+        if ylim is not None:
+            self.ax.set_ylim(bottom=ylim[0], top=ylim[1])
+        if xlabel is not None:
+            self.ax.set_xlabel(xlabel, fontsize=xlabel_fontsize)
+        if ylabel is not None:
+            self.ax.set_ylabel(ylabel, fontsize=ylabel_fontsize)
+
+        self.artists = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        plt.close(self.fig)
+
+    def save(self, *args, outpath='./plot.png'):
+        """
+        Plot new data and save
+
+        Args:
+            *args: Data, as for the plotting function; for 'plot', x1, y1, x2, y2, ..., or y1 alone,
+                with optional format strings after each line, which are also what separate
+                several y-only lines (y1, 'r', y2, 'b', ...; y1, y2 would be one line of y2 over
+                y1), and with the same number of lines every time; for 'scatter', x, y; for
+                'heatmap', the matrix
+            outpath: Path to which the visualization is saved
+                String
+                Optional; defaults to './plot.png'
+        """
+        if self.artists is None:
+            self._create(*args)
+        else:
+            self._update(*args)
+
+        # Make directory, if necessary
+        outdir = dirname(outpath)
+        if not exists(outdir):
+            makedirs(outdir, exist_ok=True)
+
+        self.fig.savefig(outpath)
+
+    def _create(self, *args):
+        if self.func == 'plot':
+            self.artists = self.ax.plot(*args, **self.kwargs)
+        elif self.func == 'scatter':
+            self.artists = [self.ax.scatter(*args, **self.kwargs)]
+        else:
+            self.artists = [self.ax.imshow(args[0], interpolation='none', **self.kwargs)]
+            if self.center_around_zero:
+                self.artists[0].set_cmap('bwr')
+            self._set_clim(args[0])
+            cax = make_axes_locatable(self.ax).append_axes('right', size='4%', pad=0.2)
+            self.fig.colorbar(self.artists[0], cax=cax)
+
+        # Legend
+        if self.labels is not None:
+            assert (len(self.labels) == len(self.artists)), \
+                "Number of labels must equal number of plot objects; use None for object without a label"
+            for artist, label in zip(self.artists, self.labels):
+                artist.set_label(label)
+            self.ax.legend(fontsize=self.legend_fontsize, loc=self.legend_loc)
+
+        # Layout, only once
+        self.fig.tight_layout()
+
+    def _update(self, *args):
+        arrays = [np.asarray(x) for x in args if not isinstance(x, str)] # skip format strings
+
+        if self.func == 'plot':
+            if len(arrays) == len(self.artists):
+                for line, y in zip(self.artists, arrays):
+                    line.set_data(np.arange(len(y)), y)
+            elif len(arrays) == 2 * len(self.artists):
+                for line, x, y in zip(self.artists, arrays[0::2], arrays[1::2]):
+                    line.set_data(x, y)
+            else:
+                raise ValueError("Number of lines must stay %d" % len(self.artists))
+        elif self.func == 'scatter':
+            self.artists[0].set_offsets(np.column_stack(arrays[:2]))
+        else:
+            self.artists[0].set_data(arrays[0])
+            self._set_clim(arrays[0])
+
+        # Autoscale axes without fixed limits
+        if self.func != 'heatmap':
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=self.xlim is None, scaley=self.ylim is None)
+
+    def _set_clim(self, mat):
+        if self.center_around_zero:
+            # vmin and vmax are set such that 0 is always no color (white)
+            v_abs_max = max(abs(np.nanmin(mat)), abs(np.nanmax(mat)))
+            self.artists[0].set_clim(-v_abs_max, v_abs_max)
+        else:
+            self.artists[0].set_clim(np.nanmin(mat), np.nanmax(mat))
+
+
+def plot_batch(series, outpaths, func='plot', **kwargs):
+    """
+    Render many plots of the same kind with one ReusablePlot
+
+    Args:
+        series: Data of each plot, i.e., positional parameters to ReusablePlot.save()
+            List of tuples (or of single arrays)
+        outpaths: Path to which each plot is saved
+            List of strings of the same length as 'series'
+        func: What to plot; see ReusablePlot
+            'plot', 'scatter', or 'heatmap'
+            Optional; defaults to 'plot'
+        **kwargs: Other keyword parameters for ReusablePlot
+    """
+    assert (len(series) == len(outpaths)), "Numbers of series and paths must be the same"
+    with ReusablePlot(func=func, **kwargs) as plot:
+        for args, outpath in zip(series, outpaths):
+            if not isinstance(args, tuple):
+                args = (args,)
+            plot.save(*args, outpath=outpath)
+
+
+class PlotQueue(object):
+    def __init__(self, n_workers=None, min_shared_bytes=1048576):
+        """
+        Asynchronous queue that renders plots in a pool of worker processes (each with its own
+            Agg backend), so that many plots are drawn in parallel rather than one after another
+            under one GIL. Arrays no smaller than 'min_shared_bytes' are handed to the workers
+            through shared memory instead of being pickled. Use it as a context manager, or call
+            close() when done
+
+        Args:
+            n_workers: Number of worker processes
+                Positive integer
+                Optional; defaults to None (number of CPUs)
+            min_shared_bytes: Arrays of at least this many bytes go through shared memory
+                Non-negative integer
+                Optional; defaults to 1048576 (1 MB)
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.min_shared_bytes = min_shared_bytes
+        self.executor = ProcessPoolExecutor(max_workers=n_workers)
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue one plot
+
+        Args:
+            func: Which plotting function of this module to invoke
+                'pyplot_wrapper', 'matrix_as_heatmap', 'scatter_on_image', 'uv_on_texmap', or
+                'axes3d_wrapper'
+            *args, **kwargs: Positional and/or keyword parameters that the plotting function takes,
+                including 'outpath', which must not be None
+
+        Returns:
+            future: Future that resolves to the output path once the plot is written, or raises
+                whatever the plotting function raised
+                concurrent.futures.Future
+        """
+        from inspect import signature
+
+        if func not in ('pyplot_wrapper', 'matrix_as_heatmap', 'scatter_on_image', 'uv_on_texmap',
+                        'axes3d_wrapper'):
+            raise NotImplementedError(func)
+
+        # Wherever 'outpath' is given, positionally or not at all
+        bound = signature(globals()[func]).bind(*args, **kwargs)
+        bound.apply_defaults()
+        outpath = bound.arguments['outpath']
+        if outpath is None:
+            raise ValueError("Plots rendered in workers must be written to 'outpath', not returned")
+
+        shms = []
+        args = tuple(self._share(x, shms) for x in args)
+        kwargs = {k: self._share(x, shms) for k, x in kwargs.items()}
+
+        try:
+            future = self.executor.submit(_render_plot, func, args, kwargs, outpath)
+        except Exception:
+            _release_shared(shms)
+            raise
+        # Shared memory is freed as soon as the worker is done with it
+        future.add_done_callback(lambda _: _release_shared(shms))
+        self.futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Block until all queued plots are written
+
+        Returns:
+            outpaths: Output path of each plot, in submission order
+                List of strings
+        """
+        outpaths = [f.result() for f in self.futures]
+        self.futures = []
+        return outpaths
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _share(self, x, shms):
+        if not isinstance(x, np.ndarray) or x.nbytes < max(self.min_shared_bytes, 1) \
+                or x.dtype.hasobject:
+            return x
+        from multiprocessing import shared_memory
+
+        shm = shared_memory.SharedMemory(create=True, size=x.nbytes)
+        shms.append(shm)
+        np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+        return _SharedArray(shm.name, x.shape, x.dtype.str)
+
+
+class _SharedArray(object):
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _release_shared(shms):
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+
+def _render_plot(func, args, kwargs, outpath):
+    from multiprocessing import shared_memory
+
+    func = globals()[func]
+    shms = []
+
+    def attach(x):
+        if not isinstance(x, _SharedArray):
+            return x
+        shm = shared_memory.SharedMemory(name=x.name)
+        shms.append(shm)
+        return np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)
+
+    args = [attach(x) for x in args]
+    kwargs = {k: attach(x) for k, x in kwargs.items()}
+
+    try:
+        func(*args, **kwargs)
+    finally:
+        # Views must go before the buffers can be closed
+        del args, kwargs
+        plt.close('all')
+        for shm in shms:
+            try:
+                shm.close()
+            except BufferError: # still referenced by a traceback; unmapped when collected
+                pass
+
+    return outpath
+
+
 def scatter_on_image(im, pts, size=2, bgr=(0, 0, 255), outpath='./scatter_on_image.png'):
     """
     Scatter plot on top of an image
+        Points are splatted all at once with precomputed disk stencils (one per distinct size),
+        giving the same pixels as drawing them one by one with cv2.circle()
 
     Args:
         im: Image to scatter on
@@ -163,47 +485,66 @@ def scatter_on_image(im, pts, size=2, bgr=(0, 0, 255), outpath='./scatter_on_ima
             v dim0
             Array_like of length 2 or shape (n, 2)
         size: Size(s) of scatter points
-            Positive float or array_like thereof of length n
+            Positive integer or array_like thereof of length n
             Optional; defaults to 2
-        bgr: BGR color(s) of scatter points
+        bgr: BGR color(s) of scatter points; where points overlap, the later one is on top
             3-tuple of integers ranging from 0 to 255 or array_like thereof of shape (n, 3)
             Optional; defaults to (0, 0, 255), i.e., all red
         outpath: Path to which the visualization is saved
-            String
+            String or None (return the image instead)
             Optional; defaults to './scatter_on_image.png'
+
+    Returns:
+        im: Image with scatter points, only if 'outpath' is None
+            h-by-w-by-3 numpy array of the input type
     """
     import cv2
 
-    thickness = -1 # for filled circles
-
     # Standardize inputs
     if im.ndim == 2: # grayscale
         im = np.dstack((im, im, im)) # to BGR
+    else:
+        im = im.copy()
     pts = np.array(pts)
     if pts.ndim == 1:
         pts = pts.reshape(-1, 2)
-    n_pts = pts.shape[0]
+    h, w = im.shape[:2]
 
     if im.dtype != 'uint8' and im.dtype != 'uint16':
         warn("Input image type may cause obscure cv2 errors")
 
-    if isinstance(size, int):
-        size = np.array([size] * n_pts)
-    else:
-        size = np.array(size)
-
+    # Constant sizes and colors are kept as scalars
+    size = np.array(size, dtype=int)
+    if size.ndim == 1 and np.all(size == size[0]):
+        size = size[0]
     bgr = np.array(bgr)
-    if bgr.ndim == 1:
-        bgr = np.tile(bgr, (n_pts, 1))
-
-    # FIXME -- necessary, probably due to OpenCV bugs?
-    im = im.copy()
+    if bgr.ndim == 2 and np.all(bgr == bgr[0]):
+        bgr = bgr[0]
+    bgr = bgr.astype(im.dtype)
 
     # Put on scatter points
-    for i in range(pts.shape[0]):
-        uv = tuple(pts[i, ::-1].astype(int))
-        color = (int(bgr[i, 0]), int(bgr[i, 1]), int(bgr[i, 2]))
-        cv2.circle(im, uv, size[i], color, thickness)
+    centers = pts.astype(int) # cv2.circle() takes integers
+    im_flat = im.reshape(-1, 3)
+    radii = [int(size)] if size.ndim == 0 else np.unique(size)
+    if bgr.ndim == 1:
+        # Same color everywhere, so only coverage matters
+        is_drawn = np.zeros(h * w, dtype=bool)
+        for r in radii:
+            ind = slice(None) if size.ndim == 0 else np.flatnonzero(size == r)
+            is_drawn[_splat_disks(centers[ind], r, h, w, return_ind=False)] = True
+        im_flat[is_drawn] = bgr
+    else:
+        # Later points are drawn on top
+        top = -np.ones(h * w, dtype=int)
+        for r in radii:
+            ind = np.arange(len(centers)) if size.ndim == 0 else np.flatnonzero(size == r)
+            pix, pt_ind = _splat_disks(centers[ind], r, h, w)
+            np.maximum.at(top, pix, ind[pt_ind])
+        is_drawn = top >= 0
+        im_flat[is_drawn] = bgr[top[is_drawn]]
+
+    if outpath is None:
+        return im
 
     # Make directory, if necessary
     outdir = dirname(outpath)
@@ -214,9 +555,51 @@ def scatter_on_image(im, pts, size=2, bgr=(0, 0, 255), outpath='./scatter_on_ima
     cv2.imwrite(outpath, im)
 
 
-def matrix_as_heatmap(mat, center_around_zero=False, outpath='./matrix_as_heatmap.png', figtitle=None):
+@lru_cache(maxsize=None)
+def _disk_stencil(radius):
+    import cv2
+
+    # Drawn by cv2 itself so that the pixels are exactly those of cv2.circle()
+    canvas = np.zeros((2 * radius + 3, 2 * radius + 3), dtype=np.uint8)
+    cv2.circle(canvas, (radius + 1, radius + 1), radius, 1, -1)
+    dy, dx = np.nonzero(canvas)
+    dy, dx = dy - radius - 1, dx - radius - 1
+    dy.flags.writeable = False # shared by all callers
+    dx.flags.writeable = False
+    return dy, dx
+
+
+def _splat_disks(centers, radius, h, w, return_ind=True):
+    """
+    Flat indices of the pixels covered by disks of the same radius, clipped to the image,
+        and (optionally) which point each pixel comes from
+    """
+    dy, dx = _disk_stencil(radius)
+    y, x = centers[:, 0], centers[:, 1]
+
+    # Disks entirely inside the image need no clipping
+    is_inside = (y >= radius) & (y < h - radius) & (x >= radius) & (x < w - radius)
+    ind_inside = np.flatnonzero(is_inside)
+    pix = ((y[ind_inside] * w + x[ind_inside])[:, None] + (dy * w + dx)).ravel()
+
+    ind_border = np.flatnonzero(~is_inside)
+    y_border = y[ind_border, None] + dy
+    x_border = x[ind_border, None] + dx
+    is_in = (y_border >= 0) & (y_border < h) & (x_border >= 0) & (x_border < w)
+    pix = np.hstack((pix, y_border[is_in] * w + x_border[is_in]))
+
+    if not return_ind:
+        return pix
+    pt_ind = np.hstack((np.repeat(ind_inside, len(dy)), ind_border[np.nonzero(is_in)[0]]))
+    return pix, pt_ind
+
+
+def matrix_as_heatmap(mat, center_around_zero=False, outpath='./matrix_as_heatmap.png', figtitle=None,
+                      colorbar=True, n_colors=256, max_size=None):
     """
     Visualizes a matrix as heatmap
+        Without title or colorbar, matplotlib is skipped altogether: values are mapped through
+        a colormap lookup table straight to pixels, one pixel per entry (after pooling)
 
     Args:
         mat: Matrix to visualize as heatmp
@@ -226,41 +609,76 @@ def matrix_as_heatmap(mat, center_around_zero=False, outpath='./matrix_as_heatma
             Boolean
             Optional; defaults to False (default colormap and auto range)
         outpath: Path to which the visualization is saved
-            String
+            String, or None (return the image instead) when there is neither title nor colorbar
             Optional; defaults to './matrix_as_heatmap.png'
         figtitle: Figure title
             String
             Optional; defaults to None (no title)
+        colorbar: Whether to draw colorbar
+            Boolean
+            Optional; defaults to True
+        n_colors: Number of colormap entries, when there is neither title nor colorbar
+            Positive integer, e.g., 256 or 1024
+            Optional; defaults to 256
+        max_size: Maximum number of rows or columns to draw; larger matrices are pooled down
+            block by block, keeping each block's minimum or maximum, whichever deviates more
+            from the colormap center, so that peaks survive
+            Positive integer
+            Optional; defaults to None (no pooling)
+
+    Returns:
+        im: Heatmap, only if there is neither title nor colorbar and 'outpath' is None
+            h-by-w-by-3 numpy array of type np.uint8 (BGR)
     """
+    import cv2
+
     figsize = 14
 
     if mat.ndim != 2:
         raise ValueError("'mat' must have exactly 2 dimensions, but has %d" % mat.ndim)
 
-    plt.figure(figsize=(figsize, figsize))
-    ax = plt.gca()
-
-    # Set title
-    if figtitle is not None:
-        ax.set_title(figtitle)
-
     if center_around_zero:
         # vmin and vmax are set such that 0 is always no color (white)
-        v_abs_max = max(abs(np.nanmin(mat)), abs(np.nanmax(mat)))
+        v_abs_max = max(abs(float(np.nanmin(mat))), abs(float(np.nanmax(mat))))
         v_max, v_min = v_abs_max, -v_abs_max
-        plt.set_cmap('bwr') # blue for negative, white for zero, red for positive
-
-        # Generate heatmap with matrix entries
-        im = ax.imshow(mat, interpolation='none', vmin=v_min, vmax=v_max)
+        cmap = 'bwr' # blue for negative, white for zero, red for positive
+    else:
+        v_max, v_min = float(np.nanmax(mat)), float(np.nanmin(mat))
+        cmap = matplotlib.rcParams['image.cmap']
+
+    if max_size is not None and max(mat.shape) > max_size:
+        mat = _pool_extrema(mat, max_size, (v_min + v_max) / 2)
+
+    if not colorbar and figtitle is None:
+        # Colormap lookup, without matplotlib
+        lut = _colormap_lut(cmap, n_colors)
+        ind = np.subtract(mat, v_min, dtype=np.result_type(mat.dtype, np.float32))
+        if v_max > v_min:
+            ind *= n_colors / (v_max - v_min)
+        is_nan = np.isnan(ind)
+        ind[is_nan] = 0
+        np.clip(ind, 0, n_colors - 1, out=ind)
+        im = lut[ind.astype(np.uint16 if n_colors <= 65536 else int)]
+        im[is_nan] = 255 # white
+        if outpath is None:
+            return im
     else:
+        plt.figure(figsize=(figsize, figsize))
+        ax = plt.gca()
+
+        # Set title
+        if figtitle is not None:
+            ax.set_title(figtitle)
+
         # Generate heatmap with matrix entries
-        im = ax.imshow(mat, interpolation='none')
+        im = ax.imshow(mat, interpolation='none', cmap=cmap, vmin=v_min, vmax=v_max)
 
-    # Colorbar
-    # Create an axes on the right side of ax; width will be 4% of ax,
-    # and the padding between cax and ax will be fixed at 0.1 inch
-    cax = make_axes_locatable(ax).append_axes('right', size='4%', pad=0.2)
-    plt.colorbar(im, cax=cax)
+        # Colorbar
+        # Create an axes on the right side of ax; width will be 4% of ax,
+        # and the padding between cax and ax will be fixed at 0.1 inch
+        if colorbar:
+            cax = make_axes_locatable(ax).append_axes('right', size='4%', pad=0.2)
+            plt.colorbar(im, cax=cax)
 
     # Make directory, if necessary
     outdir = dirname(outpath)
@@ -268,12 +686,35 @@ def matrix_as_heatmap(mat, center_around_zero=False, outpath='./matrix_as_heatma
         makedirs(outdir, exist_ok=True)
 
     # Save plot
-    plt.savefig(outpath, bbox_inches='tight')
+    if isinstance(im, np.ndarray):
+        cv2.imwrite(outpath, im)
+    else:
+        plt.savefig(outpath, bbox_inches='tight')
+        plt.close('all')
 
-    plt.close('all')
 
+@lru_cache(maxsize=None)
+def _colormap_lut(cmap, n_colors):
+    lut = plt.get_cmap(cmap, n_colors)(np.arange(n_colors))[:, 2::-1] # RGBA to BGR
+    lut = np.round(lut * 255).astype(np.uint8)
+    lut.flags.writeable = False # shared by all callers
+    return lut
 
-def uv_on_texmap(u, v, texmap, ft=None, outpath='./uv_on_texmap.png', figtitle=None):
+
+def _pool_extrema(mat, max_size, center):
+    """
+    Pool a matrix down to at most max_size-by-max_size, keeping in each block its minimum or
+        maximum, whichever is farther from center; NaN's are ignored unless a block is all NaN
+    """
+    mat = np.asarray(mat, dtype=float)
+    starts = [np.arange(0, n, int(np.ceil(n / max_size))) for n in mat.shape]
+    block_max = np.fmax.reduceat(np.fmax.reduceat(mat, starts[0], axis=0), starts[1], axis=1)
+    block_min = np.fmin.reduceat(np.fmin.reduceat(mat, starts[0], axis=0), starts[1], axis=1)
+    return np.where(
+        np.abs(block_max - center) >= np.abs(block_min - center), block_max, block_min)
+
+
+def uv_on_texmap(u, v, texmap, ft=None, outpath='./uv_on_texmap.png', figtitle=None, raster=False):
     """
     Visualizes which points on texture map the vertices map to
 
@@ -293,14 +734,20 @@ def uv_on_texmap(u, v, texmap, ft=None, outpath='./uv_on_texmap.png', figtitle=N
         texmap: Loaded texture map or its path
             h-by-w (grayscale) or h-by-w-by-3 (color) numpy array or string
         ft: Texture faces
-            List of lists of integers starting from 1, e.g., '[[1, 2, 3], [], [2, 3, 4, 5], ...]'
+            List of lists of integers starting from 1, e.g., '[[1, 2, 3], [], [2, 3, 4, 5], ...]',
+                or n-by-k numpy array thereof (all faces having k vertices)
             Optional; defaults to None. If provided, use it to connect UV points
         outpath: Path to which the visualization is saved
             String
             Optional; defaults to './uv_on_texmap.png'
-        figtitle: Figure title
+        figtitle: Figure title; ignored if 'raster' is True
             String
             Optional; defaults to None (no title)
+        raster: Whether to draw straight onto a texture-sized canvas with cv2 instead of
+            matplotlib, which is much faster and smaller for large meshes; points outside
+            the texture map are not drawn, and there is no colorbar or title
+            Boolean
+            Optional; defaults to False
     """
     import cv2
 
@@ -310,10 +757,6 @@ def uv_on_texmap(u, v, texmap, ft=None, outpath='./uv_on_texmap.png', figtitle=N
     lc = 'b' # color
     lw = 1 # width of edges connecting UV dots
 
-    fig = plt.figure(figsize=(figsize, figsize))
-    if figtitle is not None:
-        fig.title(figtitle)
-
     # Preprocess input
     if isinstance(texmap, str):
         texmap = cv2.imread(texmap, cv2.IMREAD_UNCHANGED)
@@ -333,6 +776,22 @@ def uv_on_texmap(u, v, texmap, ft=None, outpath='./uv_on_texmap.png', figtitle=N
     #   |
     #   v y
 
+    # Edges, each once
+    edges = None if ft is None else uv_edges(ft)
+
+    # Make directory, if necessary
+    outdir = dirname(outpath)
+    if not exists(outdir):
+        makedirs(outdir, exist_ok=True)
+
+    if raster:
+        _uv_on_texmap_raster(x, y, texmap, edges, outpath)
+        return
+
+    fig = plt.figure(figsize=(figsize, figsize))
+    if figtitle is not None:
+        fig.suptitle(figtitle)
+
     # UV dots
     ax = fig.gca()
     ax.set_xlim([min(0, min(x)), max(w, max(x))])
@@ -342,18 +801,9 @@ def uv_on_texmap(u, v, texmap, ft=None, outpath='./uv_on_texmap.png', figtitle=N
     ax.set_aspect('equal')
 
     # Also connect these dots
-    if ft is not None:
-        lines = []
-        for vert_id in ft:
-            if vert_id: # not empty
-                # For each face
-                ind = [i - 1 for i in vert_id]
-                n_verts = len(ind)
-                for i in range(n_verts):
-                    lines.append([
-                        (x[ind[i]], y[ind[i]]), # starting point
-                        (x[ind[(i + 1) % n_verts]], y[ind[(i + 1) % n_verts]]) # ending point
-                    ])
+    if edges is not None:
+        lines = np.stack((np.column_stack((x, y))[edges[:, 0]],
+                          np.column_stack((x, y))[edges[:, 1]]), axis=1)
         line_collection = LineCollection(lines, linewidths=lw, colors=lc)
         ax.add_collection(line_collection)
 
@@ -363,17 +813,77 @@ def uv_on_texmap(u, v, texmap, ft=None, outpath='./uv_on_texmap.png', figtitle=N
     cax = make_axes_locatable(ax).append_axes('right', size='2%', pad=0.2)
     plt.colorbar(im, cax=cax)
 
-    # Make directory, if necessary
-    outdir = dirname(outpath)
-    if not exists(outdir):
-        makedirs(outdir, exist_ok=True)
-
     # Save plot
     plt.savefig(outpath, bbox_inches='tight')
 
     plt.close('all')
 
 
+def uv_edges(ft):
+    """
+    Unique edges of texture faces, with edges shared by neighboring faces kept only once
+
+    Args:
+        ft: Texture faces
+            List of lists of integers starting from 1 (possibly empty), or n-by-k numpy array
+                thereof (all faces having k vertices)
+
+    Returns:
+        edges: Texture vertex indices (starting from 0) of edge endpoints, smaller index first
+            m-by-2 numpy array of integers
+    """
+    from itertools import chain
+
+    if isinstance(ft, np.ndarray) and ft.ndim == 2:
+        start = ft.ravel()
+        end = np.roll(ft, -1, axis=1).ravel()
+    else:
+        n_verts = np.fromiter((len(x) for x in ft), dtype=int, count=len(ft))
+        start = np.fromiter(chain.from_iterable(ft), dtype=int, count=n_verts.sum())
+        # Each vertex connects to the next one in its face, the last one to the first
+        nxt = np.arange(1, len(start) + 1)
+        face_ends = np.cumsum(n_verts)[n_verts > 0]
+        nxt[face_ends - 1] = face_ends - n_verts[n_verts > 0]
+        end = start[nxt]
+
+    # Deduplicate sorted pairs as single integers, much faster than np.unique(..., axis=0)
+    lo, hi = np.minimum(start, end) - 1, np.maximum(start, end) - 1
+    n = hi.max() + 1 if hi.size > 0 else 1
+    keys = np.sort(lo.astype(np.int64) * n + hi)
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))] if keys.size > 0 else keys
+    return np.column_stack((keys // n, keys % n))
+
+
+def _uv_on_texmap_raster(x, y, texmap, edges, outpath):
+    import cv2
+
+    shift = 4 # bits of subpixel precision
+
+    # Canvas
+    canvas = texmap
+    if canvas.ndim == 3 and canvas.shape[2] == 4:
+        canvas = canvas[:, :, :3] # drop alpha
+    if canvas.dtype == np.uint16:
+        canvas = (canvas // 257).astype(np.uint8)
+    elif canvas.dtype != np.uint8:
+        canvas = cv2.normalize(canvas, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    if canvas.ndim == 2:
+        canvas = np.dstack((canvas, canvas, canvas))
+    else:
+        canvas = canvas.copy()
+
+    # Edges, blue
+    if edges is not None:
+        xy = np.round(np.column_stack((x, y)) * (1 << shift)).astype(np.int32)
+        cv2.polylines(canvas, xy[edges], False, (255, 0, 0), thickness=1,
+                      lineType=cv2.LINE_AA, shift=shift)
+
+    # UV dots, red
+    canvas = scatter_on_image(canvas, np.column_stack((y, x)), size=1, outpath=None)
+
+    cv2.imwrite(outpath, canvas)
+
+
 def axes3d_wrapper(
         *args,
         func='scatter',
@@ -401,6 +911,9 @@ def axes3d_wrapper(
         grid=True,
         views=None,
         equal_axes=False,
+        voxel_size=None,
+        n_workers=1,
+        fps=24,
         outpath='./plot.png',
         **kwargs):
     """
@@ -441,22 +954,156 @@ def axes3d_wrapper(
         grid: Whether to draw grid
             Boolean
             Optional; defaults to True
-        views: List of elevation-azimuth angle pairs (in degree)
+        views: List of elevation-azimuth angle pairs (in degree), e.g., from turntable_views();
+            the scene is built once and only the camera moves between views
             List of 2-tuples of floats
             Optional; defaults to None
         equal_axes: Whether to have the same scale for all axes
             Boolean
             Optional; defaults to False
+        voxel_size: If given, args are taken as x1, y1, z1, x2, y2, z2, ..., and each point set is
+            decimated to one point per voxel of this size before plotting (per-point keyword
+            arrays, such as 'c', are decimated along when there is only one point set)
+            Positive float
+            Optional; defaults to None (no decimation)
+        n_workers: Number of processes rendering the views, each building the scene once
+            Positive integer
+            Optional; defaults to 1 (render in this process)
+        fps: Frame rate; effective only when writing a video
+            Positive float
+            Optional; defaults to 24
         outpath: Path to which the visualization is saved
-            String ending with '.png' or '.pkl' (for offline interactive viewing)
+            String ending with '.png' (one file per view if 'views' is given), '.pkl' (for offline
+                interactive viewing; 'views' ignored), or '.mp4' or '.avi' (frames streamed into a
+                video; requires 'views')
             Optional; defaults to './plot.png'
     """
-    fig = plt.figure(figsize=figsize)
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+    import cv2
+
+    # Everything that determines the scene, to be rebuilt as is in worker processes
+    style = dict(
+        func=func, labels=labels, legend_fontsize=legend_fontsize, legend_loc=legend_loc,
+        figsize=figsize, figtitle=figtitle, figtitle_fontsize=figtitle_fontsize,
+        xlabel=xlabel, xlabel_fontsize=xlabel_fontsize,
+        ylabel=ylabel, ylabel_fontsize=ylabel_fontsize,
+        zlabel=zlabel, zlabel_fontsize=zlabel_fontsize,
+        xticks=xticks, xticks_fontsize=xticks_fontsize, xticks_rotation=xticks_rotation,
+        yticks=yticks, yticks_fontsize=yticks_fontsize, yticks_rotation=yticks_rotation,
+        zticks=zticks, zticks_fontsize=zticks_fontsize, zticks_rotation=zticks_rotation,
+        grid=grid, equal_axes=equal_axes)
+
+    is_video = outpath.endswith(('.mp4', '.avi'))
+    if not outpath.endswith(('.png', '.pkl')) and not is_video:
+        raise ValueError("`outpath` must end with '.png', '.pkl', '.mp4', or '.avi'")
+    if is_video and views is None:
+        raise ValueError("Writing a video requires `views`")
+
+    if voxel_size is not None:
+        args, kwargs = _decimate_axes3d_args(args, kwargs, voxel_size)
+
+    # Make directory, if necessary
+    outdir = dirname(outpath)
+    if not exists(outdir):
+        makedirs(outdir, exist_ok=True)
+
+    # Single view, or the pickled axes, which can be viewed from anywhere anyway
+    if views is None or outpath.endswith('.pkl'):
+        _, ax = _axes3d_scene(args, kwargs, style)
+        if outpath.endswith('.png'):
+            plt.savefig(outpath, bbox_inches='tight')
+        else:
+            # FIXME: can't laod
+            with open(outpath, 'wb') as h:
+                dump(ax, h)
+        plt.close('all')
+        return
+
+    # Multiple views, as PNGs or video frames
+    if n_workers == 1:
+        fig, ax = _axes3d_scene(args, kwargs, style)
+        results = _axes3d_views(fig, ax, views, None if is_video else outpath)
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_axes3d_init_worker,
+                                       initargs=(args, kwargs, style))
+        chunk_size = int(np.ceil(len(views) / (4 * n_workers))) # a few chunks per worker
+        chunks = [views[i:(i + chunk_size)] for i in range(0, len(views), chunk_size)]
+        results = (x for chunk_results in executor.map(
+            _axes3d_render_chunk, chunks, repeat(None if is_video else outpath))
+                   for x in chunk_results)
+
+    try:
+        if is_video:
+            # Stream frames into the encoder as they come, in view order
+            writer = None
+            for frame in results:
+                if writer is None:
+                    fourcc = cv2.VideoWriter_fourcc(*('mp4v' if outpath.endswith('.mp4') else 'MJPG'))
+                    writer = cv2.VideoWriter(outpath, fourcc, fps, frame.shape[1::-1])
+                    if not writer.isOpened():
+                        raise IOError("Failed to open %s for writing; is the codec available?"
+                                      % outpath)
+                writer.write(frame)
+            if writer is not None:
+                writer.release()
+        else:
+            for _ in results:
+                pass
+    finally:
+        if n_workers == 1:
+            plt.close('all')
+        else:
+            executor.shutdown(wait=True)
+
+
+def turntable_views(n_views=36, elev=30):
+    """
+    Views evenly spaced around the vertical axis, for a turntable with axes3d_wrapper()
+
+    Args:
+        n_views: Number of views
+            Positive integer
+            Optional; defaults to 36
+        elev: Elevation angle in degree
+            Float
+            Optional; defaults to 30
+
+    Returns:
+        views: Elevation-azimuth angle pairs (in degree)
+            List of 2-tuples of floats
+    """
+    return [(elev, azim) for azim in np.arange(n_views) * 360 / n_views]
+
+
+def _decimate_axes3d_args(args, kwargs, voxel_size):
+    from xiuminglib import geometry as xgeo
+
+    assert len(args) % 3 == 0, "Decimation needs args to be x1, y1, z1, x2, y2, z2, ..."
+    n_sets = len(args) // 3
+    args_dec = []
+    for i in range(0, len(args), 3):
+        pts = np.column_stack([np.ravel(x) for x in args[i:(i + 3)]])
+        ind = xgeo.decimate_ptcld(pts, voxel_size)
+        args_dec += [pts[ind, 0], pts[ind, 1], pts[ind, 2]]
+        if n_sets == 1:
+            # Per-point keyword arrays go along
+            kwargs = {
+                k: np.asarray(v)[ind] if np.ndim(v) > 0 and len(v) == len(pts) else v
+                for k, v in kwargs.items()}
+    return tuple(args_dec), kwargs
+
+
+def _axes3d_scene(args, kwargs, style):
+    func = style['func']
+    labels = style['labels']
+
+    fig = plt.figure(figsize=style['figsize'])
     ax = fig.add_subplot(111, projection='3d')
 
     # Set title
-    if figtitle is not None:
-        ax.set_title(figtitle, fontsize=figtitle_fontsize)
+    if style['figtitle'] is not None:
+        ax.set_title(style['figtitle'], fontsize=style['figtitle_fontsize'])
 
     if func == 'scatter':
         func = ax.scatter
@@ -474,46 +1121,28 @@ def axes3d_wrapper(
             "Number of labels must equal number of plot objects; use None for object without a label"
         for i in range(n_plot_objs):
             plot_objs[i].set_label(labels[i])
-        plt.legend(fontsize=legend_fontsize, loc=legend_loc)
+        plt.legend(fontsize=style['legend_fontsize'], loc=style['legend_loc'])
 
     # Grid
-    plt.grid(grid)
-
-    # Axis labels
-    if xlabel is not None:
-        ax.set_xlabel(xlabel, fontsize=xlabel_fontsize)
-    if ylabel is not None:
-        ax.set_ylabel(ylabel, fontsize=ylabel_fontsize)
-    if zlabel is not None:
-        ax.set_zlabel(zlabel, fontsize=zlabel_fontsize)
-
-    # Axis ticks
-    if xticks is None:
-        ax.set_xticklabels(ax.get_xticks(), fontsize=xticks_fontsize, rotation=xticks_rotation)
-    else:
-        ax.set_xticklabels(xticks, fontsize=xticks_fontsize, rotation=xticks_rotation)
-    if yticks is None:
-        ax.set_yticklabels(ax.get_yticks(), fontsize=yticks_fontsize, rotation=yticks_rotation)
-    else:
-        ax.set_yticklabels(yticks, fontsize=yticks_fontsize, rotation=yticks_rotation)
-    if zticks is None:
-        ax.set_zticklabels(ax.get_zticks(), fontsize=zticks_fontsize, rotation=zticks_rotation)
-    else:
-        ax.set_zticklabels(zticks, fontsize=zticks_fontsize, rotation=zticks_rotation)
-
-    # Make directory, if necessary
-    outdir = dirname(outpath)
-    if not exists(outdir):
-        makedirs(outdir, exist_ok=True)
-
-    if equal_axes:
+    plt.grid(style['grid'])
+
+    # Axis labels and ticks
+    for axis in ('x', 'y', 'z'):
+        label = style[axis + 'label']
+        if label is not None:
+            getattr(ax, 'set_%slabel' % axis)(label, fontsize=style[axis + 'label_fontsize'])
+        ticks = style[axis + 'ticks']
+        if ticks is None:
+            ticks = getattr(ax, 'get_%sticks' % axis)()
+        getattr(ax, 'set_%sticklabels' % axis)(
+            ticks, fontsize=style[axis + 'ticks_fontsize'], rotation=style[axis + 'ticks_rotation'])
+
+    if style['equal_axes']:
         # plt.axis('equal') # not working, hence the hack of creating a cubic bounding box
-        x_data, y_data, z_data = np.array([]), np.array([]), np.array([])
         warn("Assuming args are x1, y1, z1, x2, y2, z2, ...")
-        for i in range(0, len(args), 3):
-            x_data = np.hstack((x_data, args[i]))
-            y_data = np.hstack((y_data, args[i + 1]))
-            z_data = np.hstack((z_data, args[i + 2]))
+        x_data = np.hstack([np.ravel(x) for x in args[0::3]])
+        y_data = np.hstack([np.ravel(x) for x in args[1::3]])
+        z_data = np.hstack([np.ravel(x) for x in args[2::3]])
         max_range = np.array([
             x_data.max() - x_data.min(),
             y_data.max() - y_data.min(),
@@ -527,29 +1156,161 @@ def axes3d_wrapper(
         for xb_, yb_, zb_ in zip(xb, yb, zb):
             ax.plot([xb_], [yb_], [zb_], 'w')
 
-    # Save plot
-    if outpath.endswith('.png'):
-        if views is None:
-            plt.savefig(outpath, bbox_inches='tight')
+    return fig, ax
+
+
+def _axes3d_views(fig, ax, views, outpath):
+    """
+    Render the views one by one, yielding either each saved path or (if outpath is None)
+        each frame as a BGR image
+    """
+    for elev, azim in views:
+        ax.view_init(elev, azim)
+        if outpath is None:
+            fig.canvas.draw()
+            yield np.ascontiguousarray(np.asarray(fig.canvas.buffer_rgba())[:, :, 2::-1])
         else:
-            for elev, azim in views:
-                ax.view_init(elev, azim)
-                plt.draw()
-                plt.savefig(outpath.replace('.png', '_elev%d_azim%d.png' % (elev, azim)),
-                            bbox_inches='tight')
-    elif outpath.endswith('.pkl'):
-        # FIXME: can't laod
-        with open(outpath, 'wb') as h:
-            dump(ax, h)
+            view_path = outpath.replace('.png', '_elev%d_azim%d.png' % (elev, azim))
+            fig.savefig(view_path, bbox_inches='tight')
+            yield view_path
+
+
+_axes3d_worker = {}
+
+
+def _axes3d_init_worker(args, kwargs, style):
+    _axes3d_worker['scene'] = (args, kwargs, style)
+    _axes3d_worker['fig_ax'] = None
+
+
+def _axes3d_render_chunk(views, outpath):
+    # The scene is built once per worker, on its first chunk
+    if _axes3d_worker['fig_ax'] is None:
+        _axes3d_worker['fig_ax'] = _axes3d_scene(*_axes3d_worker['scene'])
+    fig, ax = _axes3d_worker['fig_ax']
+    return list(_axes3d_views(fig, ax, views, outpath))
+
+
+def ptcld_as_image(pts, cam, bgr=(0, 0, 255), size=0, bg=(0, 0, 0), n_workers=1,
+                   return_depth=False, outpath='./ptcld_as_image.png'):
+    """
+    Render point cloud as image of colored disks seen by a perspective camera, without matplotlib
+        Where disks overlap, the one nearest to the camera is drawn (z-buffering)
+
+    Args:
+        pts: Cartesian coordinates in object space
+            n-by-3 array_like of floats
+        cam: Camera
+            Camera.PerspCamera
+        bgr: BGR color(s) of the points
+            3-tuple of integers ranging from 0 to 255 or array_like thereof of shape (n, 3)
+            Optional; defaults to (0, 0, 255), i.e., all red
+        size: Radius of the disks in pixels; 0 means single pixels
+            Non-negative integer
+            Optional; defaults to 0
+        bg: Background color or image
+            3-tuple of integers ranging from 0 to 255 or h-by-w-by-3 numpy array of type np.uint8
+            Optional; defaults to (0, 0, 0), i.e., black
+        n_workers: Number of processes, each z-buffering a horizontal band of the image
+            Positive integer
+            Optional; defaults to 1 (no parallelism)
+        return_depth: Whether to also return the depth (along the optical axis) of what is drawn
+            Boolean
+            Optional; defaults to False
+        outpath: Path to which the visualization is saved
+            String or None (return the image instead)
+            Optional; defaults to './ptcld_as_image.png'
+
+    Returns:
+        im: Rendering, only if 'outpath' is None
+            h-by-w-by-3 numpy array of type np.uint8
+        depth: Depth of each pixel, inf where no point is drawn; only if 'return_depth'
+            h-by-w numpy array of floats
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import cv2
+
+    h, w = cam.im_h, cam.im_w
+    pts = np.asarray(pts, dtype=float).reshape(-1, 3)
+
+    # To camera space, then pixels
+    ext_mat = cam.ext_mat
+    pts_cam = pts.dot(ext_mat[:, :3].T) + ext_mat[:, 3]
+    z = pts_cam[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vh = pts_cam[:, 1::-1] / z[:, None] * cam.f_pix + (h / 2, w / 2)
+
+    # Only points in front of the camera whose disks may reach the image
+    ind = np.flatnonzero(
+        (z > 0) & (vh[:, 0] >= -size) & (vh[:, 0] < h + size)
+        & (vh[:, 1] >= -size) & (vh[:, 1] < w + size))
+    centers = np.floor(vh[ind]).astype(int)
+
+    # Z-buffer, in one go or in bands
+    if n_workers == 1:
+        depth, drawn = _zbuffer_band(centers, z[ind], ind, size, 0, h, w)
+    else:
+        band_h = int(np.ceil(h / (4 * n_workers))) # a few bands per worker
+        band_args = []
+        for y0 in range(0, h, band_h):
+            band_h_ = min(band_h, h - y0)
+            is_near = (centers[:, 0] >= y0 - size) & (centers[:, 0] < y0 + band_h_ + size)
+            band_args.append((centers[is_near], z[ind[is_near]], ind[is_near], size, y0, band_h_, w))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            depth, drawn = zip(*executor.map(_zbuffer_band, *zip(*band_args)))
+        depth, drawn = np.hstack(depth), np.hstack(drawn)
+    is_drawn = drawn >= 0
+    drawn = drawn[is_drawn] # which point each drawn pixel shows
+
+    # Shade
+    if isinstance(bg, np.ndarray) and bg.ndim == 3:
+        im = bg.astype(np.uint8)
     else:
-        raise ValueError("`outpath` must end with either '.png' or '.pkl'")
+        im = np.empty((h, w, 3), dtype=np.uint8)
+        im[...] = bg
+    bgr = np.asarray(bgr)
+    im.reshape(-1, 3)[is_drawn] = bgr if bgr.ndim == 1 else bgr[drawn]
 
-    plt.close('all')
+    if return_depth:
+        depth = depth.reshape(h, w)
 
+    if outpath is None:
+        return (im, depth) if return_depth else im
 
-def ptcld_as_isosurf(pts, out_obj, res=128, center=False):
+    # Make directory, if necessary
+    outdir = dirname(outpath)
+    if not exists(outdir):
+        makedirs(outdir, exist_ok=True)
+
+    # Write to disk
+    cv2.imwrite(outpath, im)
+
+    if return_depth:
+        return depth
+
+
+def _zbuffer_band(centers, z, ids, radius, y0, band_h, w):
+    """
+    Depth of the nearest point covering each pixel of rows y0 to y0 + band_h - 1 (inf if none),
+        and that point's ID (-1 if none)
+    """
+    depth = np.full(band_h * w, np.inf)
+    pix, pt_ind = _splat_disks(centers - (y0, 0), radius, band_h, w)
+    z_splat = z[pt_ind]
+    np.minimum.at(depth, pix, z_splat)
+
+    # Owners are the points matching the buffer; among equally near ones, any may win
+    is_nearest = z_splat == depth[pix]
+    owner = -np.ones(band_h * w, dtype=int)
+    owner[pix[is_nearest]] = ids[pt_ind[is_nearest]]
+    return depth, owner
+
+
+def ptcld_as_isosurf(pts, out_obj, res=128, center=False, block_size=16, n_workers=1):
     """
     Visualize point cloud as isosurface of its TDF
+        Since the surface hugs the points, marching cubes runs only on blocks of the TDF near
+        them, and the pieces are stitched back together
 
     Args:
         pts: Cartesian coordinates in object space
@@ -562,18 +1323,109 @@ def ptcld_as_isosurf(pts, out_obj, res=128, center=False):
         center: Whether to center these points around object space origin
             Boolean
             Optional; defaults to False
+        block_size: Side length (in voxels) of the blocks
+            Positive integer
+            Optional; defaults to 16
+        n_workers: Number of processes running marching cubes on blocks
+            Positive integer
+            Optional; defaults to 1 (no parallelism)
     """
-    from skimage.measure import marching_cubes_lewiner
-    from trimesh import Trimesh
-    from trimesh.io.export import export_mesh
+    from concurrent.futures import ProcessPoolExecutor
     from xiuminglib import geometry as xgeo
+    from xiuminglib.geometry_models.ObjMtl import Obj
+
+    level = 0.999 / res
+
+    # Point cloud to TDF, only where there are points
+    vox_ind, vox_tdf = xgeo.ptcld2tdf_sparse(pts, res=res, center=center)
+
+    # Cubes of marching cubes span two voxels per dimension, so block b of cubes needs voxels
+    # b * block_size to (b + 1) * block_size, the last ones shared with the next block.
+    # Pair each occupied voxel with every block needing it; only these blocks have surface
+    n_blocks = (res - 2) // block_size + 1
+    vox_id, block = [], []
+    for offset in np.array(np.meshgrid([0, 1], [0, 1], [0, 1], indexing='ij')).reshape(3, -1).T:
+        block_ = (vox_ind - offset) // block_size
+        is_valid = np.all(
+            (block_ * block_size + block_size >= vox_ind) & (block_ >= 0) & (block_ < n_blocks),
+            axis=1)
+        vox_id.append(np.flatnonzero(is_valid))
+        block.append(block_[is_valid])
+    vox_id, block = np.hstack(vox_id), np.vstack(block)
+    keys = (block[:, 0] * n_blocks + block[:, 1]) * n_blocks + block[:, 2]
+    order = np.argsort(keys, kind='stable')
+    keys, vox_id, block = keys[order], vox_id[order], block[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    stops = np.append(starts[1:], len(keys))
+
+    # TDF of each block
+    block_args = []
+    for i, j in zip(starts, stops):
+        start = block[i] * block_size
+        stop = np.minimum(start + block_size + 1, res)
+        tdf = np.full(stop - start, 1 / res)
+        ind = vox_ind[vox_id[i:j]] - start
+        tdf[ind[:, 0], ind[:, 1], ind[:, 2]] = vox_tdf[vox_id[i:j]]
+        # No surface if all voxels are on one side of the level, e.g., inside a solid
+        if tdf.min() >= level or tdf.max() <= level:
+            continue
+        block_args.append((tdf, level, start))
+    if not block_args:
+        raise ValueError("No isosurface: the TDF does not cross the level anywhere")
+
+    # Isosurface of each block
+    if n_workers == 1:
+        pieces = [_isosurf_block(*x) for x in block_args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pieces = list(executor.map(_isosurf_block, *zip(*block_args)))
+
+    # Stitch: merge vertices shared by neighboring blocks
+    vs = np.vstack([x[0] for x in pieces])
+    n_vs = np.cumsum([0] + [len(x[0]) for x in pieces[:-1]])
+    fs = np.vstack([x[1] + n for x, n in zip(pieces, n_vs)])
+    vs, fs = _merge_vertices(vs, fs)
 
-    # Point cloud to TDF
-    tdf = xgeo.ptcld2tdf(pts, res=res, center=center)
+    # Normals from the stitched mesh, hence no seams; as marching cubes', pointing to
+    # decreasing TDF
+    face_normals = np.cross(vs[fs[:, 2]] - vs[fs[:, 0]], vs[fs[:, 1]] - vs[fs[:, 0]])
+    ns = np.zeros(vs.shape)
+    for i in range(3):
+        np.add.at(ns, fs[:, i], face_normals) # weighted by face areas
+    ns /= np.maximum(np.linalg.norm(ns, axis=1, keepdims=True), np.finfo(float).tiny)
 
-    # Isosurface of TDF
-    vs, fs, ns, _ = marching_cubes_lewiner(
-        tdf, 0.999 / res, spacing=(1 / res, 1 / res, 1 / res))
+    # Write, in the same units as before: TDF voxels are 1 / res apart
+    obj = Obj(o=splitext(basename(out_obj))[0], v=vs / res, f=fs + 1, vn=ns, fn=fs + 1)
+    obj.write_file(out_obj)
 
-    mesh = Trimesh(vertices=vs, faces=fs, normals=ns)
-    export_mesh(mesh, out_obj)
+
+def _isosurf_block(tdf, level, start):
+    try:
+        from skimage.measure import marching_cubes
+    except ImportError: # older scikit-image
+        from skimage.measure import marching_cubes_lewiner as marching_cubes
+
+    vs, fs, _, _ = marching_cubes(tdf, level)
+    return vs.astype(float) + start, fs
+
+
+def _merge_vertices(vs, fs, tol=1e-4):
+    """
+    Merge vertices closer than tol (in voxels), i.e., copies of the same vertex computed
+        in different blocks, and drop faces degenerated by the merging
+    """
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n = len(vs)
+    pairs = cKDTree(vs).query_pairs(tol, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    n_merged, labels = connected_components(graph, directed=False)
+
+    # Each merged vertex is where its first copy is
+    first = np.full(n_merged, n)
+    np.minimum.at(first, labels, np.arange(n))
+    fs = labels[fs]
+    fs = fs[(fs[:, 0] != fs[:, 1]) & (fs[:, 1] != fs[:, 2]) & (fs[:, 2] != fs[:, 0])]
+    return vs[first], fs